@@ -0,0 +1,77 @@
+"""
+Times deleting a large project: tickets, comments and likes are removed by ON DELETE CASCADE in the database.
+
+    python benchmarks/delete_project.py --tickets 10000 --comments 100000
+
+Runs against a throwaway SQLite database unless SQLALCHEMY_DATABASE_URI is set - the schema is created with the
+migrations and all rows are deleted by the benchmark itself.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def seed(db, models, tickets, comments, likes):
+    # bulk inserts, the ORM unit of work would dominate the setup time
+    user = models.User(email="benchmark@example.com", username="benchmark", password="-")
+    db.session.add(user)
+    db.session.flush()
+    project = models.Project(author=user.id, name="benchmark", description="", status="Open", priority="Low",
+                             deadline=date.today(), file="", developers=[user])
+    db.session.add(project)
+    db.session.flush()
+    db.session.execute(models.Ticket.__table__.insert(),
+                       [{"author": user.id, "name": f"ticket {i}", "description": "", "status": "Open",
+                         "type": "Bug", "file": "", "project_id": project.id} for i in range(tickets)])
+    ticket_ids = [ticket_id for ticket_id, in db.session.query(models.Ticket.id)
+                  .filter(models.Ticket.project_id == project.id)]
+    db.session.execute(models.user_ticket.insert(), [{"user_id": user.id, "ticket_id": i} for i in ticket_ids])
+    db.session.execute(models.Comment.__table__.insert(),
+                       [{"author_id": user.id, "text": f"comment {i}", "file": "", "deleted": False,
+                         "ticket_id": ticket_ids[i % len(ticket_ids)] if ticket_ids else None,
+                         "project_id": None if ticket_ids else project.id} for i in range(comments)])
+    comment_ids = [comment_id for comment_id, in db.session.query(models.Comment.id).limit(likes)]
+    db.session.execute(models.Like.__table__.insert(), [{"author": user.id, "comment_id": i} for i in comment_ids])
+    db.session.commit()
+    return user.id, project.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tickets", type=int, default=10000)
+    parser.add_argument("--comments", type=int, default=100000)
+    parser.add_argument("--likes", type=int, default=10000)
+    args = parser.parse_args()
+
+    if not os.getenv("SQLALCHEMY_DATABASE_URI"):
+        os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tempfile.mkdtemp()}/benchmark.db"
+    os.environ["BACKGROUND_TASKS_SYNC"] = "1"
+    from flask_migrate import upgrade
+    from flask_login import login_user
+    from web import create_app, db, models
+
+    app = create_app()
+    with app.app_context():
+        upgrade()
+        start = time.perf_counter()
+        user_id, project_id = seed(db, models, args.tickets, args.comments, args.likes)
+        print(f"seeded {args.tickets} tickets, {args.comments} comments, {args.likes} likes "
+              f"in {time.perf_counter() - start:.2f}s")
+
+    # delete through the view, as the author would
+    with app.test_request_context(f"/project-delete/{project_id}"):
+        login_user(db.session.get(models.User, user_id))
+        start = time.perf_counter()
+        app.view_functions["views.delete_project"](id_number=project_id)
+        elapsed = time.perf_counter() - start
+        remaining = {model.__name__: model.query.count() for model in (models.Ticket, models.Comment, models.Like)}
+    print(f"deleted project in {elapsed:.2f}s, remaining rows: {remaining}")
+
+
+if __name__ == "__main__":
+    main()
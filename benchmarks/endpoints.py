@@ -0,0 +1,175 @@
+"""
+Measures latency, query count and memory of the main pages at several data scales.
+
+    python benchmarks/endpoints.py --scales 1,10,50 --requests 50
+    python benchmarks/endpoints.py --compare benchmarks/results/<older commit>.json
+
+Every scale gets a fresh database filled by seed.py, pages are requested through the test client of create_app()
+as the benchmark user. Results are written to benchmarks/results/<commit>.json, --compare prints the p50 ratio
+against an older result file. Runs against throwaway SQLite databases unless SQLALCHEMY_DATABASE_URI is set - that
+database is emptied (downgraded to base) before every scale.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from seed import seed, EMAIL, PASSWORD  # noqa: E402
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+# DataTables request of the first page sorted by the second column, as sent by the tables
+TABLE = "?draw=1&start=0&length=50&order[0][column]=1&order[0][dir]=desc&search[value]="
+
+
+def endpoints(seeded):
+    # name -> url, names are the keys of the result files
+    return {"projects": "/projects",
+            "data-projects": f"/data/projects{TABLE}",
+            "project-view": f"/project-view/{seeded['project_id']}",
+            "ticket-view": f"/ticket-view/{seeded['ticket_id']}",
+            "profile": f"/profile/{seeded['user_id']}",
+            "messages": "/messages",
+            "data-messages": f"/data/messages-received{TABLE}",
+            "sidebar-status": "/sidebar-status?active=home",
+            "data-notifications": f"/data/notifications{TABLE}",
+            "search": "/search?q=login+pag"}
+
+
+def percentile(values, fraction):
+    # nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def measure(client, url, requests, statements):
+    """
+    Requests the url, warm-up requests first, then requests timed ones and one more traced by tracemalloc.
+
+    :param client: logged in test client
+    :param url: String with the url
+    :param requests: number of timed requests
+    :param statements: list the SQL statements are appended to by the engine listener
+    :return: dictionary with latency in ms, queries and peak of allocated memory per request
+    """
+    for _ in range(2):
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+    latencies, queries = [], []
+    for _ in range(requests):
+        statements.clear()
+        start = time.perf_counter()
+        client.get(url)
+        latencies.append((time.perf_counter() - start) * 1000)
+        queries.append(len(statements))
+    # tracing slows the request down, memory is measured separately from the latency
+    tracemalloc.start()
+    client.get(url)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"p50_ms": round(percentile(latencies, 0.5), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+            "mean_ms": round(sum(latencies) / len(latencies), 3),
+            "queries": percentile(queries, 0.5),
+            "peak_memory_kb": round(peak / 1024, 1)}
+
+
+def run_scale(scale, requests, rng_seed, database_uri):
+    """
+    Seeds a fresh database with the scale and measures all endpoints.
+
+    :return: dictionary with the seeded rows, seeding time and results per endpoint
+    """
+    os.environ["SQLALCHEMY_DATABASE_URI"] = database_uri or f"sqlite:///{tempfile.mkdtemp()}/benchmark.db"
+    from flask_migrate import upgrade, downgrade
+    from sqlalchemy import event
+    from web import create_app, db, models
+
+    app = create_app()
+    app.config["WTF_CSRF_ENABLED"] = False
+    with app.app_context():
+        if database_uri:
+            downgrade(revision="base")
+        upgrade()
+        start = time.perf_counter()
+        seeded = seed(db, models, scale=scale, rng=random.Random(rng_seed))
+        seed_seconds = time.perf_counter() - start
+        statements = []
+        event.listen(db.engine, "before_cursor_execute",
+                     lambda connection, cursor, statement, *args: statements.append(statement))
+
+    client = app.test_client()
+    response = client.post("/login", data={"email": EMAIL, "password": PASSWORD})
+    assert response.status_code == 302, "login failed"
+    results = {}
+    for name, url in endpoints(seeded).items():
+        results[name] = measure(client, url, requests, statements)
+        print(f"  {name:20} p50 {results[name]['p50_ms']:8.2f} ms  p99 {results[name]['p99_ms']:8.2f} ms  "
+              f"{results[name]['queries']:3} queries  {results[name]['peak_memory_kb']:8.1f} kB")
+    return {"rows": seeded["rows"], "seed_seconds": round(seed_seconds, 3), "endpoints": results}
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(result, baseline):
+    # p50 of this run relative to the baseline, per scale and endpoint present in both
+    print(f"compared with {baseline['commit']} ({baseline['created']}):")
+    for scale, scale_result in result["scales"].items():
+        old_scale = baseline["scales"].get(scale)
+        if old_scale is None:
+            continue
+        for name, numbers in scale_result["endpoints"].items():
+            old = old_scale["endpoints"].get(name)
+            if old is None:
+                continue
+            print(f"  scale {scale:>4} {name:20} p50 {old['p50_ms']:8.2f} -> {numbers['p50_ms']:8.2f} ms "
+                  f"({numbers['p50_ms'] / old['p50_ms']:5.2f}x)  queries {old['queries']} -> {numbers['queries']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scales", default="1,10", help="comma separated multipliers of seed.ROWS_PER_SCALE")
+    parser.add_argument("--requests", type=int, default=30, help="timed requests per endpoint")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="result file, benchmarks/results/<commit>.json by default")
+    parser.add_argument("--compare", help="older result file to compare with")
+    args = parser.parse_args()
+
+    database_uri = os.getenv("SQLALCHEMY_DATABASE_URI")
+    # background work (notifications, thumbnails) would run outside of the measured request
+    os.environ["BACKGROUND_TASKS_SYNC"] = "1"
+    result = {"commit": commit(),
+              "created": datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(),
+              "database": (database_uri or "sqlite").split(":")[0],
+              "requests": args.requests,
+              "scales": {}}
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        print(f"scale {scale}:")
+        result["scales"][str(scale)] = run_scale(scale, args.requests, args.seed, database_uri)
+
+    output = args.output or os.path.join(RESULTS, f"{result['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(result, file, indent=2)
+    print(f"results written to {output}")
+    if args.compare:
+        with open(args.compare) as file:
+            compare(result, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Fills a database with synthetic users, projects, tickets, comments, likes, messages and notifications.
+
+    python benchmarks/seed.py --scale 10 --seed 1
+
+Rows are bulk-inserted, one executemany per table. The same scale and seed always produce the same data, so
+benchmark results of different commits are comparable. Runs against a throwaway SQLite database unless
+SQLALCHEMY_DATABASE_URI is set - the schema is created with the migrations.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, date, timedelta
+from sqlalchemy import bindparam, func
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# rows per unit of scale
+ROWS_PER_SCALE = {"users": 10, "projects": 5, "tickets": 50, "comments": 500, "likes": 500, "messages": 200,
+                  "notifications": 500}
+EMAIL = "benchmark@example.com"
+PASSWORD = "benchmark"
+WORDS = ("login", "page", "button", "crash", "slow", "report", "database", "mobile", "layout", "export", "import",
+         "search", "profile", "upload", "error", "timeout", "cache", "query", "mail", "ticket")
+
+
+def text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def timestamps(rng, count, now, days=60):
+    # random times within the last days, sorted so that ids follow time like in a real database
+    return sorted(now - timedelta(seconds=rng.randrange(days * 24 * 3600)) for _ in range(count))
+
+
+def seed(db, models, scale=1, rng=None):
+    """
+    Inserts scale * ROWS_PER_SCALE rows. The first user (EMAIL/PASSWORD) is a developer of every project and
+    the recipient of half of the messages and notifications, so that their pages grow with the scale.
+
+    :param db: SQLAlchemy extension of the app
+    :param models: web.models module
+    :param scale: multiplier of ROWS_PER_SCALE
+    :param rng: random.Random, seeded with 0 by default
+    :return: dictionary with numbers of inserted rows and ids of the benchmark user and its busiest project/ticket
+    """
+    rng = rng or random.Random(0)
+    counts = {table: rows * scale for table, rows in ROWS_PER_SCALE.items()}
+    now = datetime.now().replace(microsecond=0)
+    password = generate_password_hash(PASSWORD)
+
+    # users - the counters are recounted on first read
+    db.session.execute(models.User.__table__.insert(),
+                       [{"email": EMAIL if i == 0 else f"user{i}@example.com",
+                         "username": "benchmark" if i == 0 else f"user{i}", "password": password,
+                         "department": rng.choice(("backend", "frontend", "qa", "design")),
+                         "description": text(rng, 12), "avatar": "/static/img/avatar-default.png",
+                         "date_created": now - timedelta(days=90), "last_update": now - timedelta(days=90),
+                         "private_profile": False, "unread_messages": None, "unread_notifications": None}
+                        for i in range(counts["users"])])
+    user_ids = [user_id for user_id, in db.session.query(models.User.id).order_by(models.User.id)]
+    benchmark_id = user_ids[0]
+
+    # projects - every project has the benchmark user and up to three other developers
+    db.session.execute(models.Project.__table__.insert(),
+                       [{"author": rng.choice(user_ids), "name": f"project {i} {text(rng, 2)}",
+                         "description": text(rng, 40), "status": rng.choice(("Open", "In progress", "Done")),
+                         "priority": rng.choice(("Low", "Medium", "High")),
+                         "deadline": date.today() + timedelta(days=rng.randrange(-30, 90)), "file": "",
+                         "date_created": created, "last_update": created}
+                        for i, created in enumerate(timestamps(rng, counts["projects"], now))])
+    project_ids = [project_id for project_id, in db.session.query(models.Project.id).order_by(models.Project.id)]
+    db.session.execute(models.user_project.insert(),
+                       [{"user_id": user_id, "project_id": project_id} for project_id in project_ids
+                        for user_id in {benchmark_id, *rng.sample(user_ids, min(3, len(user_ids)))}])
+
+    # tickets - skewed towards the first project, so that one project is much busier than the rest
+    db.session.execute(models.Ticket.__table__.insert(),
+                       [{"author": rng.choice(user_ids), "name": f"ticket {i} {text(rng, 2)}",
+                         "description": text(rng, 30), "status": rng.choice(("Open", "In progress", "Done")),
+                         "type": rng.choice(("Bug", "Feature")), "file": "",
+                         "project_id": project_ids[min(int(rng.expovariate(0.5)), len(project_ids) - 1)],
+                         "date_created": created, "last_update": created}
+                        for i, created in enumerate(timestamps(rng, counts["tickets"], now))])
+    ticket_ids = [ticket_id for ticket_id, in db.session.query(models.Ticket.id).order_by(models.Ticket.id)]
+    db.session.execute(models.user_ticket.insert(),
+                       [{"user_id": user_id, "ticket_id": ticket_id} for ticket_id in ticket_ids
+                        for user_id in set(rng.sample(user_ids, min(2, len(user_ids))))])
+
+    # comments - a quarter on projects, the rest on tickets, skewed towards the first ones
+    comments = []
+    for created in timestamps(rng, counts["comments"], now):
+        on_project = rng.random() < 0.25
+        targets = project_ids if on_project else ticket_ids
+        target = targets[min(int(rng.expovariate(0.2)), len(targets) - 1)]
+        comments.append({"author_id": rng.choice(user_ids), "text": text(rng, 20), "file": "", "deleted": False,
+                         "project_id": target if on_project else None, "ticket_id": None if on_project else target,
+                         "date_created": created, "like_count": 0})
+    db.session.execute(models.Comment.__table__.insert(), comments)
+    comment_ids = [comment_id for comment_id, in db.session.query(models.Comment.id).order_by(models.Comment.id)]
+
+    # likes - one per (user, comment), like_count kept in sync
+    liked = {(rng.choice(user_ids), rng.choice(comment_ids)) for _ in range(counts["likes"])}
+    db.session.execute(models.Like.__table__.insert(), [{"author": user_id, "comment_id": comment_id}
+                                                        for user_id, comment_id in sorted(liked)])
+    like_counts = {}
+    for _, comment_id in liked:
+        like_counts[comment_id] = like_counts.get(comment_id, 0) + 1
+    db.session.execute(models.Comment.__table__.update()
+                       .where(models.Comment.__table__.c.id == bindparam("comment_id"))
+                       .values(like_count=bindparam("likes")),
+                       [{"comment_id": comment_id, "likes": likes} for comment_id, likes in like_counts.items()])
+
+    # messages and notifications - half of them to the benchmark user
+    def recipient():
+        return benchmark_id if rng.random() < 0.5 else rng.choice(user_ids)
+
+    db.session.execute(models.UserMessage.__table__.insert(),
+                       [{"sender_id": rng.choice(user_ids), "recipient_id": recipient(), "body": text(rng, 15),
+                         "timestamp": created} for created in timestamps(rng, counts["messages"], now)])
+    db.session.execute(models.UserNotification.__table__.insert(),
+                       [{"sender_id": rng.choice(user_ids), "recipient_id": recipient(),
+                         "subject": f"user updated ticket {text(rng, 2)}", "body": text(rng, 10),
+                         "type": rng.choice(("update", "create", "comment", "delete")), "timestamp": created,
+                         "event_count": 1} for created in timestamps(rng, counts["notifications"], now)])
+    db.session.commit()
+
+    busiest_project = db.session.query(models.Ticket.project_id).group_by(models.Ticket.project_id)\
+        .order_by(func.count().desc(), models.Ticket.project_id).limit(1).scalar() or project_ids[0]
+    busiest_ticket = db.session.query(models.Comment.ticket_id).filter(models.Comment.ticket_id.isnot(None))\
+        .group_by(models.Comment.ticket_id).order_by(func.count().desc(), models.Comment.ticket_id)\
+        .limit(1).scalar() or ticket_ids[0]
+    return {"rows": dict(counts, likes=len(liked)), "user_id": benchmark_id, "project_id": busiest_project,
+            "ticket_id": busiest_ticket}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if not os.getenv("SQLALCHEMY_DATABASE_URI"):
+        os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tempfile.mkdtemp()}/benchmark.db"
+    from flask_migrate import upgrade
+    from web import create_app, db, models
+
+    app = create_app()
+    with app.app_context():
+        upgrade()
+        start = time.perf_counter()
+        seeded = seed(db, models, scale=args.scale, rng=random.Random(args.seed))
+    print(f"seeded {seeded['rows']} in {time.perf_counter() - start:.2f}s into {os.environ['SQLALCHEMY_DATABASE_URI']}")
+    print(f"log in as {EMAIL} / {PASSWORD}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Times the start of a web worker: importing the app, create_app() and the first request (template compilation).
+
+    python benchmarks/worker_boot.py --runs 5
+
+Every run is a fresh interpreter, as a new gunicorn worker without preload_app would be. Development and
+production configuration are compared, production runs share one Jinja bytecode cache directory, so the first
+production run compiles the templates and the later ones load them.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# runs inside the fresh interpreter, prints the timings as JSON
+WORKER = """
+import json, time
+started = time.perf_counter()
+from web import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+response = app.test_client().get("/login")
+assert response.status_code == 200, response.status_code
+served = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "create_app_ms": (created - imported) * 1000,
+                  "first_request_ms": (served - created) * 1000, "total_ms": (served - started) * 1000}))
+"""
+
+
+def boot(environment):
+    output = subprocess.run([sys.executable, "-c", WORKER], cwd=ROOT, env=environment, capture_output=True,
+                            text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    base = dict(os.environ, SQLALCHEMY_DATABASE_URI=os.getenv("SQLALCHEMY_DATABASE_URI",
+                                                              f"sqlite:///{directory}/benchmark.db"))
+    configurations = {
+        "development": dict(base, APP_ENV="development"),
+        "production": dict(base, APP_ENV="production", SECRET_KEY="benchmark", WEB_CONCURRENCY="1",
+                           JINJA_CACHE_DIR=os.path.join(directory, "jinja")),
+    }
+    for name, environment in configurations.items():
+        runs = [boot(environment) for _ in range(args.runs)]
+        print(f"{name}:")
+        if name == "production":
+            print(f"  {'first run (cold cache)':24} " + "  ".join(f"{key} {value:7.1f}" for key, value in runs[0].items()))
+            runs = runs[1:] or runs
+        print(f"  {'median':24} " + "  ".join(f"{key} {statistics.median(run[key] for run in runs):7.1f}"
+                                             for key in runs[0]))
+
+
+if __name__ == "__main__":
+    main()
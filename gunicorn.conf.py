@@ -0,0 +1,39 @@
+# gunicorn settings for production: gunicorn app:app
+# the app is created once in the master and forked into the workers (preload_app), workers start without importing
+# or compiling anything. create_app opens no database connections and starts no threads, so nothing is shared
+# between the forked processes.
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# every open tab holds one thread of its worker for as long as its event stream (/events) is open, size the threads
+# for the open tabs per worker plus the concurrent page requests
+threads = int(os.getenv("GUNICORN_THREADS", 32))
+worker_class = "gthread"
+preload_app = True
+timeout = 60
+graceful_timeout = 30
+# restart workers now and then, slowly growing memory is given back
+max_requests = 2000
+max_requests_jitter = 200
+
+
+# metrics of the workers are added up in METRICS_DIR (web/metrics.py), counters start from zero with every start
+def _metrics_directory(server):
+    return server.app.wsgi().config.get("METRICS_DIR")
+
+
+def on_starting(server):
+    directory = _metrics_directory(server)
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith((".json", ".tmp")):
+                os.remove(os.path.join(directory, name))
+
+
+def child_exit(server, worker):
+    directory = _metrics_directory(server)
+    if directory:
+        from web.metrics import retire_worker
+        retire_worker(directory, worker.pid)
@@ -0,0 +1,116 @@
+"""indexes, unread counters and outboxes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 17:43:51.195086
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('mail_outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('subject', sa.String(), nullable=True),
+    sa.Column('recipients', sa.String(), nullable=True),
+    sa.Column('html', sa.String(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('next_attempt', sa.DateTime(), nullable=True),
+    sa.Column('last_error', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('notification_outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('sender_id', sa.Integer(), nullable=True),
+    sa.Column('recipient_ids', sa.String(), nullable=True),
+    sa.Column('subject', sa.String(), nullable=True),
+    sa.Column('body', sa.String(), nullable=True),
+    sa.Column('type', sa.String(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['sender_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_comment_project_id'), ['project_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_comment_ticket_id'), ['ticket_id'], unique=False)
+
+    with op.batch_alter_table('like', schema=None) as batch_op:
+        batch_op.create_index('ix_like_comment_id_author', ['comment_id', 'author'], unique=False)
+
+    with op.batch_alter_table('project', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_project_author'), ['author'], unique=False)
+        batch_op.drop_column('days_left')
+
+    with op.batch_alter_table('ticket', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_ticket_author'), ['author'], unique=False)
+        batch_op.create_index(batch_op.f('ix_ticket_project_id'), ['project_id'], unique=False)
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('unread_messages', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('unread_notifications', sa.Integer(), nullable=True))
+
+    with op.batch_alter_table('user_message', schema=None) as batch_op:
+        batch_op.create_index('ix_user_message_recipient_id_timestamp', ['recipient_id', 'timestamp'], unique=False)
+        batch_op.create_index('ix_user_message_sender_id_timestamp', ['sender_id', 'timestamp'], unique=False)
+
+    with op.batch_alter_table('user_notification', schema=None) as batch_op:
+        batch_op.create_index('ix_user_notification_recipient_id_timestamp', ['recipient_id', 'timestamp'], unique=False)
+        batch_op.create_index('ix_user_notification_sender_id_timestamp', ['sender_id', 'timestamp'], unique=False)
+
+    with op.batch_alter_table('user_project', schema=None) as batch_op:
+        batch_op.create_index('ix_user_project_project_id', ['project_id'], unique=False)
+        batch_op.create_index('ix_user_project_user_id_project_id', ['user_id', 'project_id'], unique=False)
+
+    with op.batch_alter_table('user_ticket', schema=None) as batch_op:
+        batch_op.create_index('ix_user_ticket_ticket_id', ['ticket_id'], unique=False)
+        batch_op.create_index('ix_user_ticket_user_id_ticket_id', ['user_id', 'ticket_id'], unique=False)
+
+
+
+def downgrade():
+    with op.batch_alter_table('user_ticket', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_ticket_user_id_ticket_id')
+        batch_op.drop_index('ix_user_ticket_ticket_id')
+
+    with op.batch_alter_table('user_project', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_project_user_id_project_id')
+        batch_op.drop_index('ix_user_project_project_id')
+
+    with op.batch_alter_table('user_notification', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_notification_sender_id_timestamp')
+        batch_op.drop_index('ix_user_notification_recipient_id_timestamp')
+
+    with op.batch_alter_table('user_message', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_message_sender_id_timestamp')
+        batch_op.drop_index('ix_user_message_recipient_id_timestamp')
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('unread_notifications')
+        batch_op.drop_column('unread_messages')
+
+    with op.batch_alter_table('ticket', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_ticket_project_id'))
+        batch_op.drop_index(batch_op.f('ix_ticket_author'))
+
+    with op.batch_alter_table('project', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('days_left', sa.INTEGER(), nullable=True))
+        batch_op.drop_index(batch_op.f('ix_project_author'))
+
+    with op.batch_alter_table('like', schema=None) as batch_op:
+        batch_op.drop_index('ix_like_comment_id_author')
+
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_comment_ticket_id'))
+        batch_op.drop_index(batch_op.f('ix_comment_project_id'))
+
+    op.drop_table('notification_outbox')
+    op.drop_table('mail_outbox')
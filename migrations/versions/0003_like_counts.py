@@ -0,0 +1,41 @@
+"""like counts
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 17:44:34.407058
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+
+    # remove duplicate likes before they are counted and before the unique constraint is created
+    op.execute('DELETE FROM "like" WHERE id NOT IN (SELECT min(id) FROM "like" GROUP BY comment_id, author)')
+
+    # count existing likes
+    op.execute('UPDATE comment SET like_count = (SELECT count(*) FROM "like" WHERE "like".comment_id = comment.id)')
+    with op.batch_alter_table('like', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_like_comment_id_author'))
+        batch_op.create_unique_constraint('uq_like_comment_id_author', ['comment_id', 'author'])
+
+
+
+def downgrade():
+    with op.batch_alter_table('like', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_like_comment_id_author', type_='unique')
+        batch_op.create_index(batch_op.f('ix_like_comment_id_author'), ['comment_id', 'author'], unique=False)
+
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.drop_column('like_count')
+
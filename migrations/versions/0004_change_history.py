@@ -0,0 +1,41 @@
+"""change history
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 17:45:54.099486
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_history',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('entity', sa.String(), nullable=True),
+    sa.Column('entity_id', sa.Integer(), nullable=True),
+    sa.Column('field', sa.String(), nullable=True),
+    sa.Column('old_value', sa.String(), nullable=True),
+    sa.Column('new_value', sa.String(), nullable=True),
+    sa.Column('actor_id', sa.Integer(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['actor_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('change_history', schema=None) as batch_op:
+        batch_op.create_index('ix_change_history_entity_entity_id_timestamp', ['entity', 'entity_id', 'timestamp'], unique=False)
+
+
+
+def downgrade():
+    with op.batch_alter_table('change_history', schema=None) as batch_op:
+        batch_op.drop_index('ix_change_history_entity_entity_id_timestamp')
+
+    op.drop_table('change_history')
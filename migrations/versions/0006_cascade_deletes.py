@@ -0,0 +1,46 @@
+"""cascade deletes
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 17:50:15.332294
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+# foreign keys of the baseline schema are unnamed - PostgreSQL named them <table>_<column>_fkey, SQLite batch mode
+# gives the reflected constraints the same names through this naming convention
+naming_convention = {"fk": "%(table_name)s_%(column_0_name)s_fkey"}
+
+# (table, column, referred table) of the foreign keys deleting the row together with its parent
+foreign_keys = [
+    ('comment', 'project_id', 'project'),
+    ('comment', 'ticket_id', 'ticket'),
+    ('like', 'comment_id', 'comment'),
+    ('ticket', 'project_id', 'project'),
+    ('user_project', 'project_id', 'project'),
+    ('user_ticket', 'ticket_id', 'ticket'),
+]
+
+
+def _replace_foreign_keys(ondelete):
+    for table, column, referred_table in foreign_keys:
+        with op.batch_alter_table(table, schema=None, naming_convention=naming_convention) as batch_op:
+            batch_op.drop_constraint(f'{table}_{column}_fkey', type_='foreignkey')
+            batch_op.create_foreign_key(f'{table}_{column}_fkey', referred_table, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    _replace_foreign_keys(ondelete='CASCADE')
+
+
+def downgrade():
+    _replace_foreign_keys(ondelete=None)
@@ -0,0 +1,80 @@
+"""full text search
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 18:02:41.513204
+
+SQLite: FTS5 tables with the indexed tables as external content, kept in sync by triggers. Batch migrations
+that copy one of the indexed tables drop its triggers - create them again and run "flask search-reindex".
+PostgreSQL: generated tsvector columns with GIN indexes.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+# indexed table -> (columns, weights for PostgreSQL)
+indexed = {
+    'project': (('name', 'description'), ('A', 'B')),
+    'ticket': (('name', 'description'), ('A', 'B')),
+    'comment': (('text',), ('B',)),
+    'user_message': (('body',), ('B',)),
+}
+
+
+def _sqlite_upgrade(table, columns):
+    names = ', '.join(columns)
+    new = ', '.join(f'new.{name}' for name in columns)
+    old = ', '.join(f'old.{name}' for name in columns)
+    op.execute(f"CREATE VIRTUAL TABLE {table}_fts USING fts5({names}, content='{table}', content_rowid='id', "
+               f"tokenize='porter unicode61')")
+    op.execute(f"CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+               f"INSERT INTO {table}_fts(rowid, {names}) VALUES (new.id, {new}); END")
+    op.execute(f"CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+               f"INSERT INTO {table}_fts({table}_fts, rowid, {names}) VALUES ('delete', old.id, {old}); END")
+    op.execute(f"CREATE TRIGGER {table}_fts_update AFTER UPDATE OF {names} ON {table} BEGIN "
+               f"INSERT INTO {table}_fts({table}_fts, rowid, {names}) VALUES ('delete', old.id, {old}); "
+               f"INSERT INTO {table}_fts(rowid, {names}) VALUES (new.id, {new}); END")
+    op.execute(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+
+
+def _sqlite_downgrade(table):
+    for trigger in ('insert', 'delete', 'update'):
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{trigger}")
+    op.execute(f"DROP TABLE IF EXISTS {table}_fts")
+
+
+def _postgresql_upgrade(table, columns, weights):
+    vector = ' || '.join(f"setweight(to_tsvector('english', coalesce({name}, '')), '{weight}')"
+                         for name, weight in zip(columns, weights))
+    op.execute(f'ALTER TABLE "{table}" ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ({vector}) STORED')
+    op.execute(f'CREATE INDEX ix_{table}_search_vector ON "{table}" USING gin (search_vector)')
+
+
+def _postgresql_downgrade(table):
+    op.execute(f'DROP INDEX IF EXISTS ix_{table}_search_vector')
+    op.execute(f'ALTER TABLE "{table}" DROP COLUMN IF EXISTS search_vector')
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table, (columns, weights) in indexed.items():
+        if dialect == 'sqlite':
+            _sqlite_upgrade(table, columns)
+        elif dialect == 'postgresql':
+            _postgresql_upgrade(table, columns, weights)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in indexed:
+        if dialect == 'sqlite':
+            _sqlite_downgrade(table)
+        elif dialect == 'postgresql':
+            _postgresql_downgrade(table)
@@ -0,0 +1,27 @@
+"""user last update
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 17:57:38.755947
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_update', sa.DateTime(), nullable=True))
+
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('last_update')
@@ -0,0 +1,42 @@
+"""notification archive
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 18:00:46.532196
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_notification_archive',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('sender_id', sa.Integer(), nullable=True),
+    sa.Column('recipient_id', sa.Integer(), nullable=True),
+    sa.Column('subject', sa.String(), nullable=True),
+    sa.Column('body', sa.String(), nullable=True),
+    sa.Column('type', sa.String(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.Column('archived', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['recipient_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['sender_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('user_notification_archive', schema=None) as batch_op:
+        batch_op.create_index('ix_user_notification_archive_recipient_id_timestamp', ['recipient_id', 'timestamp'], unique=False)
+
+
+
+def downgrade():
+    with op.batch_alter_table('user_notification_archive', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_notification_archive_recipient_id_timestamp')
+
+    op.drop_table('user_notification_archive')
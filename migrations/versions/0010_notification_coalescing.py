@@ -0,0 +1,39 @@
+"""notification coalescing
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18 18:02:09.987004
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('notification_outbox', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('group_key', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('changes', sa.String(), nullable=True))
+
+    with op.batch_alter_table('user_notification', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('group_key', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('changes', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('event_count', sa.Integer(), server_default='1', nullable=False))
+
+
+
+def downgrade():
+    with op.batch_alter_table('user_notification', schema=None) as batch_op:
+        batch_op.drop_column('event_count')
+        batch_op.drop_column('changes')
+        batch_op.drop_column('group_key')
+
+    with op.batch_alter_table('notification_outbox', schema=None) as batch_op:
+        batch_op.drop_column('changes')
+        batch_op.drop_column('group_key')
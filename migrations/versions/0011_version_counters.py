@@ -0,0 +1,39 @@
+"""version counters
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-18 18:28:21.584139
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0011'
+down_revision = '0010'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('project', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('ticket', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('version')
+
+    with op.batch_alter_table('ticket', schema=None) as batch_op:
+        batch_op.drop_column('version')
+
+    with op.batch_alter_table('project', schema=None) as batch_op:
+        batch_op.drop_column('version')
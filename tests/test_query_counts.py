@@ -0,0 +1,106 @@
+"""
+Threads are loaded with a fixed number of statements: /project-view and /ticket-view must not execute more SQL
+for a long comment thread than for a short one (no lazy load per comment, author or like). The sidebar badges are
+served from the cached user snapshot.
+"""
+import datetime
+import re
+import pytest
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv("SQLALCHEMY_DATABASE_URI", f"sqlite:///{tmp_path}/test.db")
+    monkeypatch.setenv("BACKGROUND_TASKS_SYNC", "1")
+    monkeypatch.setenv("FRAGMENT_CACHE", "none")
+    monkeypatch.setenv("UPLOAD_FOLDER", str(tmp_path / "uploads"))
+    from flask_migrate import upgrade
+    from web import create_app
+    app = create_app()
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        upgrade()
+    return app
+
+
+@pytest.fixture
+def threads(app):
+    # a short and a long thread on a project and on a ticket, long threads have several authors and likes
+    from web import db
+    from web.models import User, Project, Ticket, Comment, Like
+    with app.app_context():
+        users = [User(email=f"user{i}@example.com", username=f"user{i}", password=generate_password_hash("pw"))
+                 for i in range(6)]
+        db.session.add_all(users)
+        db.session.flush()
+        deadline = datetime.date.today() + datetime.timedelta(days=5)
+        projects = [Project(author=users[0].id, name=f"project {i}", description="d", status="Open",
+                            priority="Low", deadline=deadline, developers=users[:3], file="") for i in range(2)]
+        db.session.add_all(projects)
+        db.session.flush()
+        tickets = [Ticket(author=users[1].id, name=f"ticket {i}", description="d", status="Open", type="Bug",
+                          project_id=projects[0].id, developers=users[:3], file="") for i in range(2)]
+        db.session.add_all(tickets)
+        db.session.flush()
+        for length, project, ticket in ((1, projects[0], tickets[0]), (30, projects[1], tickets[1])):
+            for i in range(length):
+                author = users[i % len(users)]
+                for target in ({"project_id": project.id}, {"ticket_id": ticket.id}):
+                    comment = Comment(author_id=author.id, text=f"comment {i}", file="", like_count=i % 3,
+                                      **target)
+                    db.session.add(comment)
+                    db.session.flush()
+                    db.session.add_all(Like(author=users[j].id, comment_id=comment.id) for j in range(i % 3))
+        db.session.commit()
+        return {"projects": [project.id for project in projects], "tickets": [ticket.id for ticket in tickets]}
+
+
+def record_statements(app, client, url, clear_identity=True):
+    from web import db, identity
+    statements = []
+
+    def record(connection, cursor, statement, *args):
+        statements.append(statement)
+
+    # authors cached by the previous request would make the second page cheaper
+    if clear_identity:
+        identity.clear()
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        response = client.get(url)
+    finally:
+        with app.app_context():
+            event.remove(db.engine, "before_cursor_execute", record)
+    assert response.status_code == 200, (url, response.status_code)
+    return statements
+
+
+def count_statements(app, client, url, clear_identity=True):
+    return len(record_statements(app, client, url, clear_identity))
+
+
+@pytest.mark.parametrize("page, kind", [("project-view", "projects"), ("ticket-view", "tickets")])
+def test_thread_statements_do_not_grow_with_comments(app, threads, page, kind):
+    client = app.test_client()
+    response = client.post("/login", data={"email": "user0@example.com", "password": "pw"})
+    assert response.status_code == 302
+    short_thread, long_thread = threads[kind]
+    # the first request warms up what does not depend on the page (e.g. the logged-in user)
+    count_statements(app, client, f"/{page}/{short_thread}")
+    assert count_statements(app, client, f"/{page}/{short_thread}") == \
+        count_statements(app, client, f"/{page}/{long_thread}")
+
+
+def test_warm_sidebar_status_does_not_load_the_user(app, threads):
+    client = app.test_client()
+    response = client.post("/login", data={"email": "user0@example.com", "password": "pw"})
+    assert response.status_code == 302
+    # the first poll loads the snapshot of the user and recounts the unread counters
+    count_statements(app, client, "/sidebar-status?active=home", clear_identity=False)
+    user_statements = [statement for statement in
+                       record_statements(app, client, "/sidebar-status?active=home", clear_identity=False)
+                       if re.search(r'\bFROM "?user"?(\s|$)', statement)]
+    assert user_statements == []
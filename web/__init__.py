@@ -4,43 +4,143 @@ from flask_login import LoginManager
 import secrets
 from flask_mail import Mail
 from flask_ckeditor import CKEditor
+from .events import Events
+from .tasks import BackgroundQueue
+from .cache import FragmentCache
+from .metrics import RequestMetrics
+from .identity import IdentityCache, CachedUser
 from dotenv import load_dotenv
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
+import time
 
 
 load_dotenv()
 mail = Mail()
 db = SQLAlchemy()
+events = Events()
+notification_queue = BackgroundQueue("notifications")
+mail_queue = BackgroundQueue("mail")
+file_queue = BackgroundQueue("files")
+fragments = FragmentCache()
+metrics = RequestMetrics()
+identity = IdentityCache(events)
 
 
 def create_app():
+    started = time.perf_counter()
     app = Flask(__name__)
-    app.config["SECRET_KEY"] = secrets.token_hex(16)
+    # APP_ENV=production - keys must come from the environment, Alembic is not loaded by the web workers and
+    # compiled templates are cached on the disk
+    app.config["APP_ENV"] = os.getenv("APP_ENV", "development")
+    production = app.config["APP_ENV"] == "production"
+
+    # sessions, CSRF and password reset tokens are signed with these keys - every worker and node must share them
+    app.config["SECRET_KEY"] = os.getenv("SECRET_KEY")
+    if not app.config["SECRET_KEY"]:
+        if production:
+            raise RuntimeError("SECRET_KEY must be set in production, all workers have to sign sessions with it.")
+        app.logger.warning("SECRET_KEY is not set, using a random key - sessions will not survive a restart.")
+        app.config["SECRET_KEY"] = secrets.token_hex(16)
+    app.config["JWT_SECRET"] = os.getenv("WT_SECRET") or app.config["SECRET_KEY"]
+    app.config["SESSION_COOKIE_SECURE"] = os.getenv("SESSION_COOKIE_SECURE", "1" if production else "0") == "1"
+    app.config["REMEMBER_COOKIE_SECURE"] = app.config["SESSION_COOKIE_SECURE"]
+    # number of proxies (load balancer, nginx) in front of the app, their X-Forwarded-* headers are trusted
+    app.config["TRUSTED_PROXIES"] = int(os.getenv("TRUSTED_PROXIES", 0))
+    if app.config["TRUSTED_PROXIES"]:
+        proxies = app.config["TRUSTED_PROXIES"]
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
+
     app.config['MAX_CONTENT_LENGTH'] = 3 * 1024 * 1024  # max upload size 3MB
+    # blobs are kept outside static, they are only served by /files/<sha256>/... with immutable cache headers
+    app.config['UPLOAD_FOLDER'] = os.getenv("UPLOAD_FOLDER", os.path.join(app.instance_path, "uploads"))
 
     # database config
     app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("SQLALCHEMY_DATABASE_URI")
     db.init_app(app)
 
     # mail config
-    app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-    app.config['MAIL_PORT'] = 587
+    app.config['MAIL_SERVER'] = os.getenv("MAIL_SERVER", 'smtp.gmail.com')
+    app.config['MAIL_PORT'] = int(os.getenv("MAIL_PORT", 587))
     app.config['MAIL_USE_SSL'] = False
-    app.config['MAIL_USE_TLS'] = True
+    app.config['MAIL_USE_TLS'] = os.getenv("MAIL_USE_TLS", "1") == "1"
     app.config['MAIL_DEFAULT_SENDER'] = os.getenv("MAIL_DEFAULT_SENDER")
     app.config['MAIL_USERNAME'] = os.getenv("MAIL_USERNAME")
     app.config['MAIL_PASSWORD'] = os.getenv("MAIL_PASSWORD")
     mail.init_app(app)
+    # outgoing mail queue - retries with exponential backoff (seconds), rate limit in mails per second of every
+    # sending process, N workers send up to N times the limit
+    app.config['MAIL_MAX_ATTEMPTS'] = int(os.getenv("MAIL_MAX_ATTEMPTS", 5))
+    app.config['MAIL_RETRY_BACKOFF'] = int(os.getenv("MAIL_RETRY_BACKOFF", 30))
+    app.config['MAIL_RATE_LIMIT'] = float(os.getenv("MAIL_RATE_LIMIT", 5))
+
+    # notifications older than the retention period are moved to the archive by "flask archive-notifications"
+    app.config["NOTIFICATION_RETENTION_DAYS"] = int(os.getenv("NOTIFICATION_RETENTION_DAYS", 90))
+    app.config["NOTIFICATION_ARCHIVE_BATCH"] = 1000
+    # repeated updates/comments of one object by the same user within the window (seconds) are merged into one unread
+    # notification, 0 switches coalescing off
+    app.config["NOTIFICATION_COALESCE_WINDOW"] = int(os.getenv("NOTIFICATION_COALESCE_WINDOW", 600))
+
+    # push events config - "local" or redis:// URL shared by all workers
+    app.config["EVENTS_BROKER"] = os.getenv("EVENTS_BROKER", "local")
+    if production and not app.config["EVENTS_BROKER"].startswith(("redis://", "rediss://")) \
+            and os.getenv("WEB_CONCURRENCY") != "1":
+        raise RuntimeError("EVENTS_BROKER must be a redis:// URL in production, events of the local broker do not "
+                           "reach tabs connected to the other workers (set WEB_CONCURRENCY=1 to run one worker).")
+    events.init_app(app)
+
+    # background delivery of notifications, mails and file cleanup - set BACKGROUND_TASKS_SYNC to deliver within the request
+    app.config["BACKGROUND_TASKS_SYNC"] = os.getenv("BACKGROUND_TASKS_SYNC", "") == "1"
+    app.config["BACKGROUND_WORKERS"] = int(os.getenv("BACKGROUND_WORKERS", 2))
+    # failed work (outbox entries) is retried after the backoff (seconds), doubled with every failed retry
+    app.config["BACKGROUND_RETRY_BACKOFF"] = int(os.getenv("BACKGROUND_RETRY_BACKOFF", 30))
+    app.config["BACKGROUND_RETRY_MAX_DELAY"] = int(os.getenv("BACKGROUND_RETRY_MAX_DELAY", 3600))
+    notification_queue.init_app(app)
+    mail_queue.init_app(app)
+    file_queue.init_app(app)
+
+    # rendered fragment cache - "memory" (LRU per process), "filesystem" (shared by the processes of a node) or "none"
+    app.config["FRAGMENT_CACHE"] = os.getenv("FRAGMENT_CACHE", "memory")
+    if os.getenv("FRAGMENT_CACHE_DIR"):
+        app.config["FRAGMENT_CACHE_DIR"] = os.getenv("FRAGMENT_CACHE_DIR")
+    fragments.init_app(app)
+
+    # per request SQL/template timing - slow requests and repeated statements (N+1) are logged, histograms are
+    # served in the Prometheus format at /metrics to ADMIN_EMAILS or with "Authorization: Bearer <METRICS_TOKEN>"
+    app.config["REQUEST_METRICS"] = os.getenv("REQUEST_METRICS", "1") == "1"
+    app.config["SLOW_REQUEST_MS"] = int(os.getenv("SLOW_REQUEST_MS", 500))
+    app.config["N_PLUS_ONE_THRESHOLD"] = int(os.getenv("N_PLUS_ONE_THRESHOLD", 5))
+    app.config["ADMIN_EMAILS"] = [email.strip() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()]
+    app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN", "")
+    # the workers of a node write their metrics here, /metrics adds them up - unset, every process reports its own
+    app.config["METRICS_DIR"] = os.getenv("METRICS_DIR", os.path.join(app.instance_path, "metrics") if production else "")
+    metrics.init_app(app)
+    metrics.watch(queues=[notification_queue, mail_queue, file_queue], fragment_cache=fragments, identity_cache=identity)
+
+    # snapshots of users for the user loader and author names - changed users are dropped after the commit, in all
+    # workers when EVENTS_BROKER is shared, the TTL (seconds) bounds how long a lost invalidation can go unnoticed
+    app.config["IDENTITY_CACHE_SIZE"] = int(os.getenv("IDENTITY_CACHE_SIZE", 10000))
+    app.config["IDENTITY_CACHE_TTL"] = int(os.getenv("IDENTITY_CACHE_TTL", 60))
+    identity.init_app(app)
 
     # rich text editor
     ckeditor = CKEditor()
     ckeditor.init_app(app)
 
-    # models
-    from .models import User, Project, Ticket, Comment, Like, UserMessage, UserNotification
-    with app.app_context():
-        db.create_all()
-        db.session.commit()
+    # compiled templates - shared by the workers of a node, new workers do not compile them again
+    app.config["JINJA_CACHE_DIR"] = os.getenv("JINJA_CACHE_DIR", os.path.join(app.instance_path, "jinja") if production else "")
+    if app.config["JINJA_CACHE_DIR"]:
+        os.makedirs(app.config["JINJA_CACHE_DIR"], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["JINJA_CACHE_DIR"])
+
+    # models - database schema is managed by migrations, run "flask db upgrade" before starting the app.
+    # Nothing touches the database at startup. Alembic is loaded only for the flask command (and outside production)
+    from .models import User, Project, Ticket, Comment, Like, UserMessage, UserNotification, NotificationOutbox, MailOutbox, FileBlob, \
+        UserNotificationArchive
+    if not production or os.getenv("FLASK_RUN_FROM_CLI"):
+        from flask_migrate import Migrate
+        Migrate(app, db, directory=os.path.join(os.path.dirname(os.path.dirname(__file__)), "migrations"))
 
     # blueprints
     from .views import views
@@ -48,6 +148,42 @@ def create_app():
     app.register_blueprint(views, url_prefix="/")
     app.register_blueprint(auth, url_prefix="/")
 
+    # pick up notifications left in the outbox by a previous process or by a failed delivery
+    from .helpers import deliver_pending_notifications, send_pending_mail
+    notification_queue.on_start(deliver_pending_notifications)
+    notification_queue.on_failure(deliver_pending_notifications)
+    mail_queue.on_start(send_pending_mail)
+    mail_queue.on_failure(send_pending_mail)
+    from .storage import collect_orphan_files, thumbnail_url
+    file_queue.on_start(collect_orphan_files)
+
+    @app.cli.command("deliver-notifications")
+    def deliver_notifications_command():
+        print(f"Delivered {deliver_pending_notifications()} pending notifications.")
+
+    @app.cli.command("send-mail")
+    def send_mail_command():
+        print(f"Sent {send_pending_mail()} pending mails.")
+
+    @app.cli.command("archive-notifications")
+    def archive_notifications_command():
+        from .helpers import archive_notifications
+        print(f"Archived {archive_notifications()} notifications.")
+
+    @app.cli.command("notification-stats")
+    def notification_stats_command():
+        from .helpers import notification_lag, coalescing_stats
+        depth, lag = notification_lag()
+        stats = coalescing_stats()
+        print(f"Outbox: {depth} undelivered, oldest {lag:.1f} s.")
+        print(f"Notifications: {stats['notifications']} rows for {stats['events']} events, "
+              f"{stats['rows_saved']} rows saved by coalescing.")
+
+    @app.cli.command("search-reindex")
+    def search_reindex_command():
+        from .search import rebuild_index
+        print("Search index rebuilt." if rebuild_index() else "Search index is maintained by the database.")
+
     # login manager
     login_manager = LoginManager()
     login_manager.login_view = "auth.login"
@@ -55,11 +191,19 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(id):
-        return User.query.get(int(id))
+        # cached snapshot, the User row is loaded only when the request needs more than the snapshot
+        snapshot = identity.get(int(id))
+        return CachedUser(snapshot) if snapshot is not None else None
 
     # jinja custom filters
     @app.template_filter("datetime_format")
     def datetime_format(value, format="%d-%m-%y %H:%M"):
         return value.strftime(format)
 
+    @app.template_filter("thumbnail")
+    def thumbnail(value, size):
+        return thumbnail_url(value, size)
+
+    app.config["BOOT_SECONDS"] = time.perf_counter() - started
+    app.logger.info(f"App created in {app.config['BOOT_SECONDS'] * 1000:.0f} ms ({app.config['APP_ENV']}).")
     return app
\ No newline at end of file
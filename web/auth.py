@@ -1,17 +1,15 @@
-from flask import Blueprint, render_template, redirect, url_for, flash
-from . import db, mail
+from flask import Blueprint, render_template, redirect, url_for, flash, current_app
+from . import db
 from .models import User
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from .forms import RegistrationForm, LoginForm, ResetForm, NewPasswordForm, ChangePasswordForm
-from flask_mail import Message
+from .helpers import queue_mail
 from time import time
 import jwt
-import os
 
 
 ### SETUP ###
-JWT_SECRET = os.getenv("WT_SECRET")
 auth = Blueprint("auth", __name__)
 
 
@@ -87,14 +85,14 @@ def get_reset_token(user, expires=500):
     takes user and generates expiring secret token used to verify the user
     """
     return jwt.encode({'reset_password': user.username, 'exp': time() + expires},
-                      key=JWT_SECRET)
+                      key=current_app.config["JWT_SECRET"])
 
 
 def verify_reset_token(token):
     """
     takes secret token and decodes it to get username
     """
-    username = jwt.decode(token, key=JWT_SECRET, algorithms="HS256")['reset_password']
+    username = jwt.decode(token, key=current_app.config["JWT_SECRET"], algorithms="HS256")['reset_password']
     return User.query.filter_by(username=username).first()
 
 
@@ -109,8 +107,7 @@ def password_reset():
         user = User.query.filter_by(email=form.email.data).first()
         token = get_reset_token(user=user)
         mail_content = render_template('reset-email.html', token=token)
-        msg = Message(subject="BugHunter - password reset", html=mail_content, recipients=[user.email])
-        mail.send(msg)
+        queue_mail(subject="BugHunter - password reset", html=mail_content, recipients=[user.email])
         return redirect(url_for("auth.login"))
     return render_template('reset-pw.html', form=form)
 
@@ -0,0 +1,186 @@
+from collections import OrderedDict
+from markupsafe import Markup
+import hashlib
+import os
+import threading
+import uuid
+
+
+### BACKENDS ###
+class LRUBackend:
+    """
+    In-process cache holding at most max_bytes of fragments, least recently used fragments are evicted first.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        # returns number of evicted fragments
+        evicted = 0
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, old_value = self._entries.popitem(last=False)
+                self._size -= len(old_value)
+                evicted += 1
+        return evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class FileSystemBackend:
+    """
+    Cache in a directory shared by all worker processes of the node. File modification time serves as the last use,
+    the oldest files are removed when the directory grows over max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as file:
+                value = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def set(self, key, value):
+        # returns number of evicted fragments
+        path = self._path(key)
+        temporary_path = f"{path}.{uuid.uuid4()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            file.write(value)
+        os.replace(temporary_path, path)
+        with self._lock:
+            self._size += len(value)
+            if self._size <= self.max_bytes:
+                return 0
+            return self._evict()
+
+    def _evict(self):
+        # the size is only estimated between evictions (other processes write too), recount it from the directory
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.is_file()),
+                         key=lambda entry: entry.stat().st_mtime)
+        self._size = sum(entry.stat().st_size for entry in entries)
+        evicted = 0
+        # evict down to 90 % of the limit, so that the directory is not scanned on every set
+        for entry in entries[:-1]:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._size -= entry.stat().st_size
+            evicted += 1
+        return evicted
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                os.remove(entry.path)
+        with self._lock:
+            self._size = 0
+
+
+class NullBackend:
+    # caching switched off, every fragment is rendered
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        return 0
+
+    def clear(self):
+        pass
+
+
+### FRAGMENT CACHE ###
+class FragmentCache:
+    """
+    Caches rendered HTML fragments under (fragment, user, version stamp). The stamp is read from the database and
+    changes whenever the rows shown by the fragment change, so entries are never invalidated - stale ones are
+    simply not asked for again and get evicted. The backend is chosen by the FRAGMENT_CACHE config value:
+    "memory" (default, LRU per process), "filesystem" (shared by processes, FRAGMENT_CACHE_DIR) or "none".
+    """
+
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        self._lock = threading.Lock()
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        kind = app.config.setdefault("FRAGMENT_CACHE", "memory")
+        max_bytes = app.config.setdefault("FRAGMENT_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+        directory = app.config.setdefault("FRAGMENT_CACHE_DIR", os.path.join(app.instance_path, "fragments"))
+        if kind == "filesystem":
+            self.backend = FileSystemBackend(directory, max_bytes)
+        elif kind == "memory":
+            self.backend = LRUBackend(max_bytes)
+        else:
+            self.backend = NullBackend()
+
+    def render(self, fragment, stamp, render, user_id=None):
+        """
+        Returns the cached fragment, or renders and stores it.
+
+        :param fragment: name of the fragment, e.g. "project-comments"
+        :param stamp: version stamp of the data shown by the fragment
+        :param render: function returning the html of the fragment, called on a miss
+        :param user_id: User.id for fragments that differ between users
+        :return: Markup with the html
+        """
+        key = f"{fragment}:{user_id}:{stamp}"
+        value = self.backend.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return Markup(value)
+        value = str(render())
+        evicted = self.backend.set(key, value)
+        with self._lock:
+            self.misses += 1
+            self.evictions += evicted
+        return Markup(value)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / requests if requests else 0.0}
@@ -0,0 +1,103 @@
+from flask import get_template_attribute, jsonify
+from sqlalchemy import or_, select
+from . import db
+
+
+# template holding one macro per rendered table cell
+CELLS_TEMPLATE = "datatable-cells.html"
+MAX_PAGE_LENGTH = 200
+
+
+def _int_arg(args, name, default):
+    try:
+        return int(args.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def datatable_response(query, model, columns, args, search_columns=()):
+    """
+    Answers a DataTables server-side processing request (paging, sort, search) for the given query.
+    Rows are paged with a keyset cursor when the client sends 'after' (id of the last row of the previous page),
+    so moving to the next page costs an index seek instead of skipping 'start' rows. Plain offset paging is used
+    as a fallback when the client jumps to an arbitrary page. The client sends back the counts of the previous
+    response ('total', 'filtered'), the next pages of a cursor are served without counting.
+
+    :param query: Query of the visible rows, e.g. user_projects(current_user)
+    :param model: Model class of the rows, its 'id' column is used as the tiebreaker of the sort order
+    :param columns: list of (sort expression or None, macro name) tuples in the order of the table columns;
+                    the macro from datatable-cells.html renders the cell for each row
+    :param args: request.args sent by DataTables
+    :param search_columns: columns matched against the search box value
+    :return: JSON response with draw, recordsTotal, recordsFiltered, data and next cursor
+    """
+    draw = _int_arg(args, "draw", 0)
+    start = max(_int_arg(args, "start", 0), 0)
+    length = _int_arg(args, "length", 50)
+    if length < 1 or length > MAX_PAGE_LENGTH:
+        length = MAX_PAGE_LENGTH
+
+    # sort - always finish with id so that the order (and the keyset cursor) is unique. NULLs are placed explicitly
+    # (last when ascending, first when descending - the order of a PostgreSQL index), so that the cursor can skip them
+    column_index = _int_arg(args, "order[0][column]", 0)
+    if column_index >= len(columns) or columns[column_index][0] is None:
+        column_index = 0
+    sort_column = columns[column_index][0] if columns[column_index][0] is not None else model.id
+    descending = args.get("order[0][dir]") == "desc"
+    if descending:
+        query = query.order_by(None).order_by(sort_column.desc().nulls_first(), model.id.desc())
+    else:
+        query = query.order_by(None).order_by(sort_column.asc().nulls_last(), model.id.asc())
+
+    # the last row of the previous page, None when the client jumps to an arbitrary page
+    after = _int_arg(args, "after", None)
+    last_row = None
+    if after is not None:
+        last_row = db.session.query(sort_column.is_(None)).filter(model.id == after).first()
+
+    # counts - the next pages of a cursor reuse the counts of the previous page sent back by the client, the total
+    # does not depend on the search, so a request counts at most once
+    search = args.get("search[value]", "").strip()
+    searching = bool(search and search_columns)
+    known_total = _int_arg(args, "total", None)
+    known_filtered = _int_arg(args, "filtered", None)
+    unfiltered = query
+    if searching:
+        pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        query = query.filter(or_(*[column.ilike(pattern, escape="\\") for column in search_columns]))
+    if last_row is not None and known_total is not None and known_filtered is not None:
+        records_total, records_filtered = known_total, known_filtered
+    else:
+        records_filtered = query.order_by(None).count()
+        if not searching:
+            records_total = records_filtered
+        elif known_total is not None:
+            records_total = known_total
+        else:
+            records_total = unfiltered.order_by(None).count()
+
+    # page
+    if last_row is not None:
+        # compare with the sort value of the last row inside the database, values are never round-tripped
+        last_value = select(sort_column).where(model.id == after).scalar_subquery()
+        after_null, = last_row
+        if descending and after_null:
+            query = query.filter(or_(sort_column.isnot(None), sort_column.is_(None) & (model.id < after)))
+        elif descending:
+            query = query.filter(or_(sort_column < last_value, (sort_column == last_value) & (model.id < after)))
+        elif after_null:
+            query = query.filter(sort_column.is_(None), model.id > after)
+        else:
+            query = query.filter(or_(sort_column > last_value, (sort_column == last_value) & (model.id > after),
+                                     sort_column.is_(None)))
+        rows = query.limit(length).all()
+    else:
+        rows = query.offset(start).limit(length).all()
+
+    macros = [get_template_attribute(CELLS_TEMPLATE, macro) for _, macro in columns]
+    data = [[str(macro(row)) for macro in macros] for row in rows]
+    return jsonify(draw=draw,
+                   recordsTotal=records_total,
+                   recordsFiltered=records_filtered,
+                   data=data,
+                   next=rows[-1].id if rows else None)
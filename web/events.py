@@ -0,0 +1,134 @@
+from collections import defaultdict
+import queue
+import threading
+
+
+### BACKENDS ###
+class LocalBackend:
+    """
+    In-process publish/subscribe. Delivers events only to subscribers connected to the same worker process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def subscribe(self, channel):
+        return LocalSubscription(self, channel)
+
+
+class LocalSubscription:
+    def __init__(self, backend, channel):
+        self.backend = backend
+        self.channel = channel
+        self.queue = queue.Queue()
+        with backend._lock:
+            backend._subscribers[channel].add(self.queue)
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.backend._lock:
+            self.backend._subscribers[self.channel].discard(self.queue)
+            if not self.backend._subscribers[self.channel]:
+                del self.backend._subscribers[self.channel]
+
+
+class RedisBackend:
+    """
+    Publish/subscribe through Redis, delivers events to subscribers connected to any worker or node.
+    """
+
+    def __init__(self, url):
+        # optional dependency, needed only when EVENTS_BROKER points to Redis
+        import redis
+        self.redis = redis.Redis.from_url(url)
+
+    def publish(self, channel, event):
+        self.redis.publish(channel, event)
+
+    def subscribe(self, channel):
+        return RedisSubscription(self.redis, channel)
+
+
+class RedisSubscription:
+    def __init__(self, redis, channel):
+        self.pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def get(self, timeout):
+        message = self.pubsub.get_message(timeout=timeout)
+        if message is None:
+            return None
+        return message["data"].decode()
+
+    def close(self):
+        self.pubsub.close()
+
+
+### EVENTS ###
+class Events:
+    """
+    Pushes badge updates to the users' open tabs. The backend is chosen by the EVENTS_BROKER config value:
+    "local" (default) for a single worker process, or a redis:// URL to fan out across workers.
+    """
+
+    def __init__(self, app=None):
+        self.backend = LocalBackend()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        broker = app.config.setdefault("EVENTS_BROKER", "local")
+        app.config.setdefault("EVENTS_HEARTBEAT", 15)
+        self.heartbeat = app.config["EVENTS_HEARTBEAT"]
+        if broker.startswith(("redis://", "rediss://")):
+            self.backend = RedisBackend(broker)
+        else:
+            self.backend = LocalBackend()
+
+    @staticmethod
+    def channel(user_id):
+        return f"user-events-{user_id}"
+
+    def publish(self, user_ids, event):
+        """
+        Sends event to all open tabs of the users.
+
+        :param user_ids: list of User.id
+        :param event: string with event name: "messages" or "notifications"
+        :return: True if successful
+        """
+        for user_id in set(user_ids):
+            self.backend.publish(self.channel(user_id), event)
+        return True
+
+    def stream(self, user_id):
+        """
+        Generator of Server-Sent Events for the user. Sends a comment line as a heartbeat when idle so that
+        closed connections are detected.
+
+        :param user_id: User.id
+        :return: generator of strings in the text/event-stream format
+        """
+        subscription = self.backend.subscribe(self.channel(user_id))
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                event = subscription.get(timeout=self.heartbeat)
+                if event is None:
+                    yield ": heartbeat\n\n"
+                else:
+                    yield f"event: {event}\ndata: {event}\n\n"
+        finally:
+            subscription.close()
@@ -1,101 +1,434 @@
-from deepdiff import DeepDiff
-import uuid
-from werkzeug.utils import secure_filename
+from sqlalchemy import insert, select
+from sqlalchemy.sql import func
 from flask_login import current_user
-from .models import Project, User, UserNotification
-from . import db
-import os
-from datetime import date
+from .models import User, UserNotification, UserNotificationArchive, NotificationOutbox, MailOutbox, ChangeHistory
+from . import db, events, notification_queue, mail, mail_queue, identity
+from flask import current_app, request, session, g, Response
+from werkzeug.http import is_resource_modified
+from flask_mail import Message
+from sqlalchemy import or_
+from datetime import datetime, timedelta, date
+import hashlib
+import json
+import time
+import smtplib
 
 
-def update_days_left():
+def store_version(version):
     """
-    Updates the 'days_left' column of all existing projects in the database with integer of the whole days left.
+    Takes Ticket or Project object and returns dictionary with its tracked fields. Used for tracking of changes
+    when object is updated by the user.
 
-    :return: True if successful
+    :param version: Object of either Project or Ticket class
+    :return: Dictionary with field names as keys and string values
     """
-    for project in Project.query.all():
-        days_left = project.deadline - date.today()
-        project.days_left = days_left.days
-        db.session.commit()
-    return True
+    version_details = {field: str(getattr(version, field)) for field in version.tracked_fields}
+    version_details["developers"] = ", ".join(sorted(developer.username for developer in version.developers))
+    return version_details
 
 
-def upload_file(file, project_name):
+def record_changes(version, old_version):
     """
-    Saves a file uploaded by the user and returns string with the filepath. The file name is hashed to allow
-    uploading multiple files of the same name.
+    Compares the Ticket/Project with its details saved before the update and adds a ChangeHistory row for each
+    changed field to the session, the rows are committed together with the update.
 
-    :param file: (werkzeug.datastructures.FileStorage) A file uploaded by the user
-    :param project_name: Name of the project under which the file will be stored
-    :return: String with the filepath: f'/static/uploads/{project_name}/{filename}
+    :param version: Object of either Project or Ticket class after the update
+    :param old_version: Dictionary of object details returned by the store_version function before the update
+    :return: list of ChangeHistory objects
     """
-    salt = str(uuid.uuid4())
-    filename = f"{salt}{secure_filename(file.filename)}"
-    filepath = f'web/static/uploads/{project_name}'
-    save_path = f"{filepath}/{filename}"
-    browser_path = f'/static/uploads/{project_name}/{filename}'
-    if not os.path.exists(filepath):
-        os.makedirs(filepath)
-    file.save(save_path)
-    return browser_path
+    changes = [ChangeHistory(entity=version.__tablename__,
+                             entity_id=version.id,
+                             field=field,
+                             old_value=old_version.get(field),
+                             new_value=value,
+                             actor_id=current_user.id)
+               for field, value in store_version(version).items() if old_version.get(field) != value]
+    db.session.add_all(changes)
+    return changes
 
 
-def store_version(version):
+def describe_changes(changes):
     """
-    Takes Ticket or Project object and returns dictionary with saved data. Used for tracking of changes
-    when object is updated by the user.
+    Returns notification text describing the changes.
 
-    :param version: Object of either Project or Ticket class
-    :return: Dictionary with object data details
-    """
-    version_details = {}
-    # get list of currently assigned developers
-    developer_list = [developer.username for developer in version.developers]
-    # save last update in string
-    last_update_string = version.last_update.strftime("%d-%m-%y %H:%M")
-    # create dictionary with column.name as key
-    for column in version.__table__.columns:
-        version_details[column.name] = str(getattr(version, column.name))
-    # add developer list to dictionary, change the format of last_update
-    version_details["developers"] = str(developer_list)
-    version_details["last_update"] = last_update_string
-    return version_details
+    :param changes: list of [field, old value, new value] lists
+    :return: String with one line per changed field
+    """
+    return "\n".join(f'{field} changed from "{old_value}" to "{new_value}".' for field, old_value, new_value in changes)
 
 
-def compare_versions(old_version, new_version):
+def merge_changes(changes, later_changes):
     """
-    Compares two dictionaries with Ticket/Project details and returns a string with changed values.
+    Merges two change lists of the same object into the net change: the first old value and the last new value
+    of each field, fields changed back to their original value are dropped.
 
-    :param old_version: Dictionary of object details returned by the store_version function
-    :param new_version: Dictionary of object details returned by the store_version function
-    :return: String with difference between the two objects
+    :param changes: list of [field, old value, new value] lists
+    :param later_changes: list of [field, old value, new value] lists recorded after changes
+    :return: list of [field, old value, new value] lists
     """
-    difference = DeepDiff(old_version, new_version)
-    difference_string = difference.pretty().replace("Value of root['", "").replace("'] changed from", " changed from")
-    return difference_string
+    merged = {field: [field, old_value, new_value] for field, old_value, new_value in changes}
+    for field, old_value, new_value in later_changes:
+        merged.setdefault(field, [field, old_value, new_value])[2] = new_value
+    return [change for change in merged.values() if change[1] != change[2]]
 
 
-def send_notification(recipients, body, notification_type, subject):
+def send_notification(recipient_ids, body, notification_type, subject, group_key=None, changes=None):
     """
-    Creates a UserNotification object for each of the recipients.
+    Stores the notification event in the outbox and hands it over to the background queue, the request does not
+    wait for the fan-out. Recipients are deduplicated and the current_user never notifies themselves.
 
-    :param recipients: list of User objects, usually Developers of the given Project/Ticket
+    :param recipient_ids: list of User.id, usually Developers of the given Project/Ticket
     :param body: string of the body text of the notification
     :param notification_type: string: "update", "create", "delete", "comment" - used for styling of the html page
     :param subject: string of the notification subject
+    :param group_key: string identifying the notified object, e.g. "project:1" - events with the same key, sender
+                      and type are coalesced into one notification, None never coalesces
+    :param changes: list of [field, old value, new value] lists described by the body of an "update" notification
+    :return: True if successful
+    """
+    recipient_ids = sorted(set(recipient_ids) - {current_user.id})
+    if not recipient_ids:
+        return True
+    outbox = NotificationOutbox(sender_id=current_user.id,
+                                recipient_ids=",".join(str(recipient_id) for recipient_id in recipient_ids),
+                                subject=subject,
+                                body=body,
+                                type=notification_type,
+                                group_key=group_key,
+                                changes=json.dumps(changes) if changes is not None else None)
+    db.session.add(outbox)
+    db.session.commit()
+    notification_queue.submit(deliver_notification, outbox.id)
+    return True
+
+
+def deliver_notification(outbox_id):
+    """
+    Creates a UserNotification row for each recipient of the outbox entry with a single multi-row INSERT. The entry
+    is deleted in the same transaction, so it is never delivered twice even if several workers pick it up.
+    Recipients who have not read an earlier notification of the same group yet get that one updated instead,
+    see coalesce_notification.
+
+    :param outbox_id: NotificationOutbox.id
+    :return: True if delivered, False if already delivered by someone else
+    """
+    outbox = db.session.get(NotificationOutbox, outbox_id)
+    if outbox is None:
+        return False
+    claimed = NotificationOutbox.query.filter_by(id=outbox_id).delete(synchronize_session=False)
+    if not claimed:
+        db.session.rollback()
+        return False
+    recipient_ids = [int(recipient_id) for recipient_id in outbox.recipient_ids.split(",")]
+    coalesced = coalesce_notification(outbox, recipient_ids)
+    new_recipient_ids = [recipient_id for recipient_id in recipient_ids if recipient_id not in coalesced]
+    if new_recipient_ids:
+        db.session.execute(insert(UserNotification), [dict(sender_id=outbox.sender_id,
+                                                           recipient_id=recipient_id,
+                                                           subject=outbox.subject,
+                                                           body=outbox.body,
+                                                           type=outbox.type,
+                                                           timestamp=outbox.timestamp,
+                                                           group_key=outbox.group_key,
+                                                           changes=outbox.changes)
+                                                      for recipient_id in new_recipient_ids])
+    db.session.commit()
+    # coalesced notifications were unread already, only the new ones are counted
+    count_unread(recipient_ids=new_recipient_ids, counter=User.unread_notifications)
+    events.publish(user_ids=recipient_ids, event="notifications")
+    return True
+
+
+def coalesce_notification(outbox, recipient_ids):
+    """
+    Merges the outbox entry into the unread notifications of the same sender, type and group_key that are younger
+    than NOTIFICATION_COALESCE_WINDOW seconds (measured from the first merged event). Update notifications get
+    the net change list, other bodies are appended. Changes are added to the session, the caller commits.
+
+    :param outbox: NotificationOutbox object
+    :param recipient_ids: list of User.id
+    :return: set of User.id whose notification was updated
+    """
+    window = current_app.config["NOTIFICATION_COALESCE_WINDOW"]
+    if not outbox.group_key or not window:
+        return set()
+    # unread - newer than the last visit of the notifications page
+    candidates = UserNotification.query.join(User, User.id == UserNotification.recipient_id)\
+        .filter(UserNotification.recipient_id.in_(recipient_ids),
+                UserNotification.sender_id == outbox.sender_id,
+                UserNotification.type == outbox.type,
+                UserNotification.group_key == outbox.group_key,
+                UserNotification.timestamp >= outbox.timestamp - timedelta(seconds=window),
+                or_(User.last_notification_read_time.is_(None),
+                    UserNotification.timestamp > User.last_notification_read_time))\
+        .order_by(UserNotification.timestamp.desc(), UserNotification.id.desc()).all()
+    coalesced = set()
+    for notification in candidates:
+        if notification.recipient_id in coalesced:
+            continue
+        if notification.changes is not None and outbox.changes is not None:
+            changes = merge_changes(json.loads(notification.changes), json.loads(outbox.changes))
+            notification.changes = json.dumps(changes)
+            notification.body = describe_changes(changes)
+        else:
+            notification.body = f"{notification.body}\n{outbox.body}"
+        notification.subject = outbox.subject
+        notification.event_count += 1
+        coalesced.add(notification.recipient_id)
+    return coalesced
+
+
+def coalescing_stats():
+    """
+    Returns numbers of stored notifications and of the events they describe, used for monitoring of coalescing.
+    Every coalesced event is one UserNotification row that was not written. Archived notifications are included.
+
+    :return: dictionary with "notifications", "events" and "rows_saved"
+    """
+    notifications = events_count = 0
+    for model in (UserNotification, UserNotificationArchive):
+        rows, events = db.session.query(func.count(model.id), func.coalesce(func.sum(model.event_count), 0)).one()
+        notifications += rows
+        events_count += events
+    return {"notifications": notifications,
+            "events": events_count,
+            "rows_saved": events_count - notifications}
+
+
+def deliver_pending_notifications():
+    """
+    Delivers outbox entries left undelivered, e.g. by a process that stopped before its queue was drained or by
+    a failed delivery. Entries failing again are skipped and retried later with backoff.
+
+    :return: number of delivered entries
+    """
+    pending = [outbox_id for outbox_id, in db.session.query(NotificationOutbox.id).order_by(NotificationOutbox.id)]
+    delivered = failed = 0
+    for outbox_id in pending:
+        try:
+            delivered += deliver_notification(outbox_id)
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception(f"Delivering notification outbox entry {outbox_id} failed")
+            failed += 1
+    if failed:
+        notification_queue.retry_later(deliver_pending_notifications)
+    return delivered
+
+
+def notification_lag():
+    """
+    Returns number of undelivered outbox entries and age of the oldest one in seconds, used for monitoring
+    of the queue.
+
+    :return: tuple (depth, lag in seconds)
+    """
+    depth, oldest, now = db.session.query(func.count(NotificationOutbox.id), func.min(NotificationOutbox.timestamp),
+                                          func.now()).one()
+    if not oldest:
+        return depth, 0.0
+    # database time is used on both sides, timestamps are stored by func.now()
+    if isinstance(now, str):
+        now = datetime.fromisoformat(now)
+    return depth, max((now - oldest).total_seconds(), 0.0)
+
+
+def archive_notifications(retention_days=None, batch_size=None):
+    """
+    Moves notifications older than the retention period to UserNotificationArchive, one batch per transaction so
+    that the hot table is never locked for long. Unread counters of the recipients are set to NULL and recounted
+    on the next read, archived notifications no longer count.
+
+    :param retention_days: age in days, NOTIFICATION_RETENTION_DAYS by default
+    :param batch_size: notifications moved per transaction, NOTIFICATION_ARCHIVE_BATCH by default
+    :return: number of archived notifications
+    """
+    retention_days = retention_days or current_app.config["NOTIFICATION_RETENTION_DAYS"]
+    batch_size = batch_size or current_app.config["NOTIFICATION_ARCHIVE_BATCH"]
+    # database time is used on both sides, timestamps are stored by func.now()
+    now = db.session.query(func.now()).scalar()
+    if isinstance(now, str):
+        now = datetime.fromisoformat(now)
+    cutoff = now - timedelta(days=retention_days)
+    columns = ["id", "sender_id", "recipient_id", "subject", "body", "type", "timestamp", "group_key", "changes",
+               "event_count"]
+    archived = 0
+    while True:
+        batch = db.session.query(UserNotification.id, UserNotification.recipient_id)\
+            .filter(UserNotification.timestamp < cutoff).order_by(UserNotification.timestamp).limit(batch_size).all()
+        if not batch:
+            return archived
+        notification_ids = [notification_id for notification_id, _ in batch]
+        source = select(*[UserNotification.__table__.c[column] for column in columns])\
+            .where(UserNotification.id.in_(notification_ids))
+        db.session.execute(insert(UserNotificationArchive).from_select(columns, source))
+        UserNotification.query.filter(UserNotification.id.in_(notification_ids)).delete(synchronize_session=False)
+        recipient_ids = {recipient_id for _, recipient_id in batch}
+        User.query.filter(User.id.in_(recipient_ids))\
+            .update({User.unread_notifications: None}, synchronize_session=False)
+        db.session.commit()
+        identity.invalidate(recipient_ids)
+        archived += len(batch)
+
+
+def count_unread(recipient_ids, counter):
+    """
+    Increments cached unread counter of the recipients with a single UPDATE. Counters that were not initialized yet
+    (NULL) are left alone, they are recounted when read.
+
+    :param recipient_ids: list of User.id
+    :param counter: User.unread_messages or User.unread_notifications
     :return: True if successful
     """
-    notifications = []
-    for recipient in recipients:
-        recipient = User.query.filter_by(id=recipient.id).first_or_404()
-        notification = UserNotification(author=current_user,
-                                        recipient=recipient,
-                                        subject=subject,
-                                        body=body,
-                                        type=notification_type
-                                        )
-        notifications.append(notification)
-    db.session.add_all(notifications)
+    if recipient_ids:
+        User.query.filter(User.id.in_(recipient_ids), counter.isnot(None))\
+            .update({counter: counter + 1}, synchronize_session=False)
+        db.session.commit()
+
+        def increment(snapshot):
+            unread = getattr(snapshot, counter.key)
+            return snapshot if unread is None else snapshot._replace(**{counter.key: unread + 1})
+
+        identity.update(recipient_ids, increment)
+    return True
+
+
+def queue_mail(subject, html, recipients):
+    """
+    Stores the mail in the outbox and hands it over to the background mail queue, the request does not wait
+    for the SMTP server.
+
+    :param subject: string of the mail subject
+    :param html: string with rendered html body of the mail
+    :param recipients: list of email addresses
+    :return: True if successful
+    """
+    db.session.add(MailOutbox(subject=subject, html=html, recipients=",".join(recipients)))
     db.session.commit()
-    return True
\ No newline at end of file
+    mail_queue.submit(send_pending_mail)
+    return True
+
+
+def _claim_mail(mail_id, now, lease):
+    # marks the mail as being sent, returns False if another worker claimed it first
+    claimed = MailOutbox.query.filter(MailOutbox.id == mail_id,
+                                      or_(MailOutbox.next_attempt.is_(None), MailOutbox.next_attempt <= now))\
+        .update({MailOutbox.next_attempt: now + lease}, synchronize_session=False)
+    db.session.commit()
+    return bool(claimed)
+
+
+def send_pending_mail():
+    """
+    Sends all mails that are due over one SMTP connection. Failed mails are retried with exponential backoff
+    up to MAIL_MAX_ATTEMPTS times, sending is limited to MAIL_RATE_LIMIT mails per second. The limit holds per
+    sending loop - every worker process sends at its own rate. The queue keeps a single retry timer however many
+    runs ask for one.
+
+    :return: number of sent mails
+    """
+    config = current_app.config
+    max_attempts = config.get("MAIL_MAX_ATTEMPTS", 5)
+    rate_limit = config.get("MAIL_RATE_LIMIT", 5)
+    backoff = config.get("MAIL_RETRY_BACKOFF", 30)
+    lease = timedelta(seconds=config.get("MAIL_SEND_TIMEOUT", 300))
+    now = datetime.now()
+    due = [mail_id for mail_id, in db.session.query(MailOutbox.id)
+           .filter(MailOutbox.attempts < max_attempts,
+                   or_(MailOutbox.next_attempt.is_(None), MailOutbox.next_attempt <= now))
+           .order_by(MailOutbox.id)]
+    if not due:
+        return 0
+    sent = 0
+    try:
+        with mail.connect() as connection:
+            sent = _send_mails(connection, due, backoff=backoff, rate_limit=rate_limit, lease=lease)
+    except (OSError, smtplib.SMTPException) as error:
+        # SMTP server not reachable - all due mails are tried again after the backoff of the queue, doubled with
+        # every failed connection
+        current_app.logger.warning(f"Connecting to the mail server failed: {error}")
+        mail_queue.retry_later(send_pending_mail)
+        return sent
+    # wake up again when the first failed mail is due for a retry
+    next_retry = db.session.query(func.min(MailOutbox.next_attempt))\
+        .filter(MailOutbox.attempts.between(1, max_attempts - 1)).scalar()
+    if next_retry:
+        mail_queue.retry_later(send_pending_mail, delay=max((next_retry - datetime.now()).total_seconds(), 1))
+    return sent
+
+
+def _send_mails(connection, mail_ids, backoff, rate_limit, lease):
+    # sends the mails over an open SMTP connection, failed mails are scheduled for a retry
+    sent = 0
+    for mail_id in mail_ids:
+        if not _claim_mail(mail_id, now=datetime.now(), lease=lease):
+            continue
+        outgoing = db.session.get(MailOutbox, mail_id)
+        started = time.monotonic()
+        try:
+            connection.send(Message(subject=outgoing.subject,
+                                    html=outgoing.html,
+                                    recipients=outgoing.recipients.split(",")))
+        except Exception as error:
+            outgoing.attempts += 1
+            outgoing.last_error = str(error)
+            outgoing.next_attempt = datetime.now() + timedelta(seconds=backoff * 2 ** (outgoing.attempts - 1))
+            db.session.commit()
+            current_app.logger.warning(f"Sending mail {mail_id} failed ({outgoing.attempts}x): {error}")
+            continue
+        db.session.delete(outgoing)
+        db.session.commit()
+        sent += 1
+        # rate limit
+        time.sleep(max(1 / rate_limit - (time.monotonic() - started), 0))
+    return sent
+
+
+def page_etag(*parts):
+    """
+    Returns ETag of a page shown to the current_user. Besides the parts describing the page content it covers
+    the sidebar (avatar, unread badges), days left to deadlines (date) and the age of the CSRF token in the forms,
+    a revalidated page never carries an expired token.
+
+    :param parts: values that change whenever the content of the page changes
+    :return: String with the ETag
+    """
+    token_age = current_app.config.get("WTF_CSRF_TIME_LIMIT") or 3600
+    state = [current_user.id, current_user.version, current_user.new_notifications(), current_user.new_messages(),
+             date.today(), int(time.time() // (token_age / 2)), *parts]
+    return hashlib.sha1("-".join(str(part) for part in state).encode()).hexdigest()
+
+
+def not_modified(etag, last_modified=None):
+    """
+    Returns 304 response when the browser revalidates a page it already has in the current version, None when the
+    page has to be rendered. Pages with pending flash messages are always rendered.
+
+    :param etag: String from page_etag
+    :param last_modified: datetime of the last change, browsers sending If-None-Match are answered by the ETag
+    :return: Response or None
+    """
+    if session.get("_flashes") or request.method != "GET":
+        # the page shows the messages once, it must not be reused later
+        g.page_uncacheable = True
+        return None
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return conditional(Response(status=304), etag, last_modified)
+
+
+def conditional(response, etag, last_modified=None):
+    """
+    Adds validators to a rendered page, the browser revalidates the page on every visit.
+    Pages rendered with flash messages or answering a form get no validators.
+
+    :return: the response
+    """
+    if g.get("page_uncacheable"):
+        response.headers["Cache-Control"] = "no-store"
+        return response
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
@@ -0,0 +1,260 @@
+from collections import OrderedDict, namedtuple
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from .events import LocalBackend
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+# read-only copy of the User columns that every page shows (sidebar, avatars, badges), the password is never cached
+UserSnapshot = namedtuple("UserSnapshot", ["id", "email", "username", "avatar", "department", "private_profile",
+                                           "last_update", "version", "last_message_read_time",
+                                           "last_notification_read_time", "unread_messages", "unread_notifications"])
+# ids of changed users are published here, so that other workers drop their copies
+CHANNEL = "identity-invalidate"
+
+
+### IDENTITY CACHE ###
+class IdentityCache:
+    """
+    Bounded LRU cache of UserSnapshot objects with a time to live, used by the user loader and for author names
+    instead of a primary key lookup per request. A user is dropped from the cache after every commit that changes
+    their row through the ORM and by invalidate() after bulk updates. Incremented unread counters are applied to
+    the cached copies by update() instead, so the badges of the next request need no query. With a redis://
+    EVENTS_BROKER the ids are published to all workers, IDENTITY_CACHE_TTL bounds the staleness if a message is lost.
+    """
+
+    def __init__(self, events=None, app=None):
+        self.events = events
+        self.max_size = 10000
+        self.ttl = 60
+        self._lock = threading.Lock()
+        # user id -> (snapshot, expiry)
+        self._entries = OrderedDict()
+        self._listener = None
+        self._hooked = False
+        # number of invalidations, snapshots loaded while a user was invalidated are not stored
+        self._generation = 0
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config.setdefault("IDENTITY_CACHE_SIZE", 10000)
+        self.ttl = app.config.setdefault("IDENTITY_CACHE_TTL", 60)
+        if not self._hooked:
+            self._hooked = True
+            event.listen(Session, "after_flush", _collect_changed_users)
+            event.listen(Session, "after_commit", self._after_commit)
+            event.listen(Session, "after_rollback", _forget_changed_users)
+
+    def get(self, user_id):
+        """
+        Returns snapshot of the user, loaded from the database on a miss.
+
+        :param user_id: User.id
+        :return: UserSnapshot, None if there is no such user
+        """
+        return self.many([user_id]).get(user_id)
+
+    def many(self, user_ids):
+        """
+        Returns snapshots of the users, all misses are loaded with one query.
+
+        :param user_ids: list of User.id
+        :return: dictionary User.id -> UserSnapshot, users that do not exist are left out
+        """
+        self._listen()
+        now = time.monotonic()
+        snapshots = {}
+        with self._lock:
+            for user_id in set(user_ids):
+                entry = self._entries.get(user_id)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(user_id)
+                    snapshots[user_id] = entry[0]
+            self.hits += len(snapshots)
+            missing = [user_id for user_id in set(user_ids) if user_id not in snapshots]
+            self.misses += len(missing)
+            generation = self._generation
+        if missing:
+            loaded = _load_snapshots(missing)
+            with self._lock:
+                # a commit invalidated users while loading, the loaded rows may be older than the commit
+                if generation != self._generation:
+                    snapshots.update(loaded)
+                    return snapshots
+                for user_id, snapshot in loaded.items():
+                    self._entries[user_id] = (snapshot, now + self.ttl)
+                    self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            snapshots.update(loaded)
+        return snapshots
+
+    def invalidate(self, user_ids):
+        """
+        Drops the users from the cache of this process and of all other workers. Call after the change is committed.
+
+        :param user_ids: list of User.id
+        :return: True if successful
+        """
+        user_ids = set(user_ids)
+        if not user_ids:
+            return True
+        self._drop(user_ids)
+        self._publish(user_ids)
+        return True
+
+    def update(self, user_ids, change):
+        """
+        Applies a committed bulk update to the snapshots cached by this process, other workers drop their copies.
+        Users that are not cached are left alone, they are loaded with the change.
+
+        :param user_ids: list of User.id
+        :param change: function taking a UserSnapshot and returning the changed one
+        :return: True if successful
+        """
+        user_ids = set(user_ids)
+        if not user_ids:
+            return True
+        with self._lock:
+            # snapshots being loaded may be older than the update, they are not stored
+            self._generation += 1
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry is not None:
+                    self._entries[user_id] = (change(entry[0]), entry[1])
+        self._publish(user_ids)
+        return True
+
+    def _publish(self, user_ids):
+        if self.events is not None and not isinstance(self.events.backend, LocalBackend):
+            try:
+                self.events.backend.publish(CHANNEL, ",".join(str(user_id) for user_id in sorted(user_ids)))
+            except Exception:
+                # other workers catch up when their copies expire
+                logger.exception("publishing identity invalidation failed")
+
+    def _drop(self, user_ids):
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def _after_commit(self, session):
+        changed = session.info.pop("identity_changed", None)
+        if changed:
+            self.invalidate(changed)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def _listen(self):
+        # subscribes to invalidations of other workers before anything is cached, the thread starts lazily so that
+        # forked workers do not inherit it
+        if self._listener is not None or self.events is None or isinstance(self.events.backend, LocalBackend):
+            return
+        with self._lock:
+            if self._listener is not None:
+                return
+            try:
+                subscription = self.events.backend.subscribe(CHANNEL)
+            except Exception:
+                logger.exception("subscribing to identity invalidations failed")
+                return
+            self._listener = threading.Thread(target=self._receive, args=(subscription,), name="identity",
+                                              daemon=True)
+            self._listener.start()
+
+    def _receive(self, subscription):
+        try:
+            while True:
+                message = subscription.get(timeout=self.ttl)
+                if message:
+                    self._drop(int(user_id) for user_id in message.split(","))
+        except Exception:
+            logger.exception("identity invalidation listener stopped")
+        finally:
+            subscription.close()
+            # invalidations may have been missed, start over with an empty cache and a new subscription
+            with self._lock:
+                self._generation += 1
+                self._entries.clear()
+                self._listener = None
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "hit_ratio": self.hits / requests if requests else 0.0}
+
+
+def _load_snapshots(user_ids):
+    # models need the db of the package, they are imported when the app is running
+    from .models import User
+    from . import db
+    columns = [getattr(User, field) for field in UserSnapshot._fields]
+    return {row.id: UserSnapshot(*row) for row in db.session.query(*columns).filter(User.id.in_(user_ids))}
+
+
+### SESSION HOOKS ###
+#  Users changed through the ORM (profile, avatar, password, read times, recounted counters) are collected on flush
+#  and dropped from the cache once the transaction is committed (IdentityCache._after_commit).
+def _collect_changed_users(session, flush_context):
+    from .models import User
+    changed = session.info.setdefault("identity_changed", set())
+    for instance in session.dirty:
+        if isinstance(instance, User) and session.is_modified(instance, include_collections=False):
+            changed.add(instance.id)
+
+
+def _forget_changed_users(session):
+    session.info.pop("identity_changed", None)
+
+
+### CURRENT USER ###
+class CachedUser(UserMixin):
+    """
+    current_user served from a UserSnapshot. Snapshot columns and unread counters are read without a query, anything
+    else (relationships, the password, methods and assignments) loads the User row once and is delegated to it.
+    """
+
+    def __init__(self, snapshot):
+        object.__setattr__(self, "_snapshot", snapshot)
+        object.__setattr__(self, "_user", None)
+
+    @property
+    def user(self):
+        if self._user is None:
+            from .models import User
+            from . import db
+            object.__setattr__(self, "_user", db.session.get(User, self._snapshot.id))
+        return self._user
+
+    def __getattr__(self, name):
+        # called only for names not defined on the class, the loaded row wins over the snapshot
+        if self._user is None and name in UserSnapshot._fields:
+            return getattr(self._snapshot, name)
+        return getattr(self.user, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.user, name, value)
+
+    def new_messages(self):
+        if self._user is None and self._snapshot.unread_messages is not None:
+            return self._snapshot.unread_messages
+        return self.user.new_messages()
+
+    def new_notifications(self):
+        if self._user is None and self._snapshot.unread_notifications is not None:
+            return self._snapshot.unread_notifications
+        return self.user.new_notifications()
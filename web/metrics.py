@@ -0,0 +1,395 @@
+from flask import request, g, has_request_context, request_started, request_finished, before_render_template, \
+    template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import Counter
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+# upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+# metrics of exited workers are merged into this file of METRICS_DIR
+RETIRED = "retired.json"
+# stats of the queues and caches: counters are summed over all workers, gauges over the running ones
+QUEUE_COUNTERS = ("submitted", "completed", "failed")
+CACHE_COUNTERS = ("hits", "misses", "evictions")
+
+
+### HISTOGRAM ###
+class Histogram:
+    """
+    Prometheus histogram with one series per endpoint: cumulative bucket counts, sum and count of observations.
+    """
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # endpoint -> [counts per bucket..., sum, count]
+        self._series = {}
+
+    def observe(self, endpoint, value):
+        with self._lock:
+            series = self._series.setdefault(endpoint, [0] * len(self.buckets) + [0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: list(series) for endpoint, series in self._series.items()}
+
+    def render(self, all_series=None):
+        # all_series: endpoint -> series, e.g. added up over the workers, the series of this process by default
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        if all_series is None:
+            all_series = self.snapshot()
+        for endpoint, series in sorted(all_series.items()):
+            label = f'endpoint="{_escape(endpoint)}"'
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _metric(name, help_text, metric_type, samples):
+    # samples: list of (labels dictionary, value)
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        label = ",".join(f'{key}="{_escape(label_value)}"' for key, label_value in labels.items())
+        lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+    return lines
+
+
+### REQUEST METRICS ###
+class RequestMetrics:
+    """
+    Records SQL statements, SQL time, template render time and total latency of every request, aggregated per
+    endpoint into histograms rendered in the Prometheus text format. Requests repeating one statement at least
+    N_PLUS_ONE_THRESHOLD times (a lazy load in a loop) and requests slower than SLOW_REQUEST_MS are logged with
+    their statements. With METRICS_DIR set every worker writes its metrics to a file in the directory (a second
+    after a request) and /metrics, answered by any worker, adds up the files of all workers of the node.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.slow_request = 0.5
+        self.n_plus_one_threshold = 5
+        self.request_duration = Histogram("bughunter_request_duration_seconds",
+                                          "Time from the start of the request to the response.", SECONDS_BUCKETS)
+        self.sql_duration = Histogram("bughunter_request_sql_duration_seconds",
+                                      "Time spent executing SQL statements per request.", SECONDS_BUCKETS)
+        self.template_duration = Histogram("bughunter_request_template_duration_seconds",
+                                           "Time spent rendering templates per request.", SECONDS_BUCKETS)
+        self.queries = Histogram("bughunter_request_queries", "SQL statements executed per request.", QUERIES_BUCKETS)
+        self._lock = threading.Lock()
+        self.n_plus_one = Counter()
+        self.slow_requests = Counter()
+        self.directory = ""
+        self._dump_pending = False
+        # queues and caches reported with the requests, see watch()
+        self.queues = ()
+        self.fragment_cache = None
+        self.identity_cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.setdefault("REQUEST_METRICS", True)
+        self.slow_request = app.config.setdefault("SLOW_REQUEST_MS", 500) / 1000
+        self.n_plus_one_threshold = app.config.setdefault("N_PLUS_ONE_THRESHOLD", 5)
+        self.directory = app.config.setdefault("METRICS_DIR", "")
+        if not self.enabled:
+            return
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        request_started.connect(self._request_started, app)
+        request_finished.connect(self._request_finished, app)
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+
+    def watch(self, queues=(), fragment_cache=None, identity_cache=None):
+        """
+        Reports stats of the queues and caches together with the request metrics.
+
+        :param queues: list of BackgroundQueue objects
+        :param fragment_cache: FragmentCache object
+        :param identity_cache: IdentityCache object
+        """
+        self.queues = tuple(queues)
+        self.fragment_cache = fragment_cache
+        self.identity_cache = identity_cache
+
+    # signal receivers, state of the running request is kept in g
+    def _request_started(self, sender, **extra):
+        g.metrics_start = time.perf_counter()
+        g.metrics_statements = []
+        g.metrics_render_depth = 0
+        g.metrics_template_time = 0.0
+
+    def _render_started(self, sender, template, context, **extra):
+        if "metrics_start" not in g:
+            return
+        if g.metrics_render_depth == 0:
+            g.metrics_render_start = time.perf_counter()
+        g.metrics_render_depth += 1
+
+    def _render_finished(self, sender, template, context, **extra):
+        if "metrics_start" not in g:
+            return
+        g.metrics_render_depth -= 1
+        # templates rendered from another template (fragments) are counted once, in the outer one
+        if g.metrics_render_depth == 0:
+            g.metrics_template_time += time.perf_counter() - g.metrics_render_start
+
+    def _request_finished(self, sender, response, **extra):
+        if "metrics_start" not in g:
+            return
+        duration = time.perf_counter() - g.metrics_start
+        statements = g.metrics_statements
+        endpoint = request.endpoint or "none"
+        self.record(endpoint, duration, statements, g.metrics_template_time)
+
+    def record(self, endpoint, duration, statements, template_time):
+        """
+        Adds one request to the metrics, logs it if it is slow or repeats a statement.
+
+        :param endpoint: name of the Flask endpoint, e.g. "views.projects"
+        :param duration: latency of the request in seconds
+        :param statements: list of (SQL statement, duration in seconds) tuples executed by the request
+        :param template_time: time spent rendering templates in seconds
+        """
+        sql_time = sum(statement_time for _, statement_time in statements)
+        self.request_duration.observe(endpoint, duration)
+        self.sql_duration.observe(endpoint, sql_time)
+        self.template_duration.observe(endpoint, template_time)
+        self.queries.observe(endpoint, len(statements))
+        statement, repeats = Counter(statement for statement, _ in statements).most_common(1)[0] \
+            if statements else ("", 0)
+        if repeats >= self.n_plus_one_threshold:
+            with self._lock:
+                self.n_plus_one[endpoint] += 1
+            logger.warning("possible N+1 in %s: statement executed %d times: %s", endpoint, repeats,
+                           " ".join(statement.split()))
+        if duration >= self.slow_request:
+            with self._lock:
+                self.slow_requests[endpoint] += 1
+            logger.warning("slow request %s %s: %.0f ms, %d statements (%.0f ms), templates %.0f ms\n%s",
+                           endpoint, request.full_path if has_request_context() else "", duration * 1000,
+                           len(statements), sql_time * 1000, template_time * 1000,
+                           "\n".join(f"  {statement_time * 1000:7.2f} ms  {' '.join(statement.split())}"
+                                     for statement, statement_time in statements))
+        if self.directory:
+            self._schedule_dump()
+
+    def state(self):
+        """
+        Returns the metrics of this process as a JSON serializable dictionary.
+        """
+        with self._lock:
+            state = {"pid": os.getpid(),
+                     "histograms": {histogram.name: histogram.snapshot() for histogram in self._histograms()},
+                     "n_plus_one": dict(self.n_plus_one),
+                     "slow_requests": dict(self.slow_requests)}
+        state["queues"] = {queue.name: queue.stats() for queue in self.queues}
+        state["fragment_cache"] = self.fragment_cache.stats() if self.fragment_cache is not None else {}
+        state["identity_cache"] = self.identity_cache.stats() if self.identity_cache is not None else {}
+        return state
+
+    def _schedule_dump(self):
+        # one pending write per process, requests within the next second are written with it
+        with self._lock:
+            if self._dump_pending:
+                return
+            self._dump_pending = True
+        timer = threading.Timer(1, self._scheduled_dump)
+        timer.daemon = True
+        timer.start()
+
+    def _scheduled_dump(self):
+        with self._lock:
+            self._dump_pending = False
+        self.dump()
+
+    def dump(self):
+        # written to a temporary file first, readers never see a half written file
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary, "w") as file:
+                json.dump(self.state(), file)
+            os.replace(temporary, path)
+        except OSError:
+            logger.exception("writing metrics to %s failed", self.directory)
+
+    def _histograms(self):
+        return self.request_duration, self.sql_duration, self.template_duration, self.queries
+
+    def render(self):
+        """
+        Returns metrics of this process, or of all workers with METRICS_DIR, in the Prometheus text exposition
+        format.
+
+        :return: String ending with a newline
+        """
+        if self.directory:
+            self.dump()
+            states, running = read_states(self.directory)
+        else:
+            states = running = [self.state()]
+        total = merge_states(states, running)
+        lines = []
+        for histogram in self._histograms():
+            lines += histogram.render(total["histograms"].get(histogram.name, {}))
+        lines += _metric("bughunter_n_plus_one_requests_total", "Requests repeating one SQL statement.",
+                         "counter", [({"endpoint": endpoint}, count)
+                                     for endpoint, count in sorted(total["n_plus_one"].items())])
+        lines += _metric("bughunter_slow_requests_total", "Requests slower than SLOW_REQUEST_MS.",
+                         "counter", [({"endpoint": endpoint}, count)
+                                     for endpoint, count in sorted(total["slow_requests"].items())])
+        if total["queues"]:
+            stats = sorted(total["queues"].items())
+            lines += _metric("bughunter_queue_tasks_total", "Background tasks by state.", "counter",
+                             [({"queue": name, "state": state}, queue_stats[state]) for name, queue_stats in stats
+                              for state in QUEUE_COUNTERS])
+            lines += _metric("bughunter_queue_depth", "Background tasks not finished yet.", "gauge",
+                             [({"queue": name}, queue_stats["depth"]) for name, queue_stats in stats])
+            lines += _metric("bughunter_queue_max_lag_seconds", "Longest wait of a task for a worker.", "gauge",
+                             [({"queue": name}, queue_stats["max_lag_seconds"]) for name, queue_stats in stats])
+        if self.fragment_cache is not None:
+            for name in CACHE_COUNTERS:
+                lines += _metric(f"bughunter_fragment_cache_{name}_total", f"Fragment cache {name}.", "counter",
+                                 [({}, total["fragment_cache"].get(name, 0))])
+        if self.identity_cache is not None:
+            for name in ("hits", "misses"):
+                lines += _metric(f"bughunter_identity_cache_{name}_total", f"User snapshot cache {name}.", "counter",
+                                 [({}, total["identity_cache"].get(name, 0))])
+            lines += _metric("bughunter_identity_cache_size", "Users in the snapshot cache.", "gauge",
+                             [({}, total["identity_cache"].get("size", 0))])
+        return "\n".join(lines) + "\n"
+
+
+### WORKERS ###
+#  Metrics files of METRICS_DIR: <pid>.json of every worker and retired.json with the counters of exited workers.
+def read_states(directory):
+    """
+    Reads the metrics files of all workers.
+
+    :param directory: METRICS_DIR
+    :return: tuple (list of all states, list of states of running workers)
+    """
+    states, running = [], []
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            continue
+        states.append(state)
+        if name != RETIRED and _running(state["pid"]):
+            running.append(state)
+    return states, running
+
+
+def merge_states(states, running):
+    """
+    Adds up the metrics of several workers: histograms and counters of all of them, gauges (queue depth and lag,
+    cache size) of the running ones.
+
+    :param states: list of dictionaries returned by RequestMetrics.state()
+    :param running: states of the running workers, gauges are taken from these
+    :return: dictionary in the format of RequestMetrics.state()
+    """
+    total = {"histograms": {}, "n_plus_one": Counter(), "slow_requests": Counter(), "queues": {},
+             "fragment_cache": Counter(), "identity_cache": Counter()}
+    for state in states:
+        for name, all_series in state.get("histograms", {}).items():
+            merged = total["histograms"].setdefault(name, {})
+            for endpoint, series in all_series.items():
+                merged[endpoint] = [a + b for a, b in zip(merged[endpoint], series)] if endpoint in merged \
+                    else list(series)
+        total["n_plus_one"].update(state.get("n_plus_one", {}))
+        total["slow_requests"].update(state.get("slow_requests", {}))
+        for name, queue_stats in state.get("queues", {}).items():
+            queue_total = total["queues"].setdefault(name, {"depth": 0, "max_lag_seconds": 0.0,
+                                                            **{counter: 0 for counter in QUEUE_COUNTERS}})
+            for counter in QUEUE_COUNTERS:
+                queue_total[counter] += queue_stats.get(counter, 0)
+        for cache in ("fragment_cache", "identity_cache"):
+            total[cache].update({counter: state.get(cache, {}).get(counter, 0) for counter in CACHE_COUNTERS})
+    for state in running:
+        for name, queue_stats in state.get("queues", {}).items():
+            total["queues"][name]["depth"] += queue_stats["depth"]
+            total["queues"][name]["max_lag_seconds"] = max(total["queues"][name]["max_lag_seconds"],
+                                                           queue_stats["max_lag_seconds"])
+        total["identity_cache"]["size"] += state.get("identity_cache", {}).get("size", 0)
+    return total
+
+
+def retire_worker(directory, pid):
+    """
+    Merges the counters of an exited worker into retired.json, called by the gunicorn master (gunicorn.conf.py).
+
+    :param directory: METRICS_DIR
+    :param pid: process id of the worker
+    """
+    path = os.path.join(directory, f"{pid}.json")
+    retired_path = os.path.join(directory, RETIRED)
+    states = []
+    for state_path in (retired_path, path):
+        try:
+            with open(state_path) as file:
+                states.append(json.load(file))
+        except (OSError, ValueError):
+            pass
+    total = merge_states(states, [])
+    total["pid"] = 0
+    total["queues"] = {name: {counter: queue_stats[counter] for counter in QUEUE_COUNTERS}
+                       for name, queue_stats in total["queues"].items()}
+    temporary = f"{retired_path}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(total, file)
+    os.replace(temporary, retired_path)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# statements are timed on every engine, only those executed within a request are recorded
+@event.listens_for(Engine, "before_cursor_execute")
+def _statement_started(connection, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "metrics_statements" in g:
+        context._metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _statement_finished(connection, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_metrics_start", None)
+    if start is not None and has_request_context() and "metrics_statements" in g:
+        g.metrics_statements.append((statement, time.perf_counter() - start))
@@ -1,19 +1,55 @@
 from . import db
 from flask_login import UserMixin
-from sqlalchemy.sql import func
-from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import func, select
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import column_property
+from datetime import datetime, date
+import sqlite3
+
+
+# SQL expression with the number of whole days from today until the given date column
+class days_until(FunctionElement):
+    type = db.Integer()
+    inherit_cache = True
+
+
+@compiles(days_until)
+def _days_until_default(element, compiler, **kw):
+    # PostgreSQL - subtracting two dates returns integer of days
+    return f"({compiler.process(element.clauses, **kw)} - CURRENT_DATE)"
+
+
+@compiles(days_until, "sqlite")
+def _days_until_sqlite(element, compiler, **kw):
+    return f"CAST(julianday({compiler.process(element.clauses, **kw)}) - julianday(date('now', 'localtime')) AS INTEGER)"
+
+
+# SQLite enforces foreign keys (and ON DELETE CASCADE) only when they are enabled on each connection
+@event.listens_for(Engine, "connect")
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute("PRAGMA foreign_keys=ON")
 
 
 # setting up many-to-many relationship for User-Projects Project-Developers
 user_project = db.Table("user_project",
                         db.Column("user_id", db.Integer(), db.ForeignKey("user.id")),
-                        db.Column("project_id", db.Integer(), db.ForeignKey("project.id"))
+                        db.Column("project_id", db.Integer(), db.ForeignKey("project.id", ondelete="CASCADE")),
+                        # "my projects" lookup by user, developers of a project by project
+                        db.Index("ix_user_project_user_id_project_id", "user_id", "project_id"),
+                        db.Index("ix_user_project_project_id", "project_id")
                         )
 
 # setting up many-to-many relationship for User-Tickets Tickets-Developers
 user_ticket = db.Table("user_ticket",
                        db.Column("user_id", db.Integer(), db.ForeignKey("user.id")),
-                       db.Column("ticket_id", db.Integer(), db.ForeignKey("ticket.id"))
+                       db.Column("ticket_id", db.Integer(), db.ForeignKey("ticket.id", ondelete="CASCADE")),
+                       db.Index("ix_user_ticket_user_id_ticket_id", "user_id", "ticket_id"),
+                       db.Index("ix_user_ticket_ticket_id", "ticket_id")
                        )
 
 
@@ -41,49 +77,96 @@ class User(db.Model, UserMixin):
                                             backref='recipient', lazy='dynamic')
     last_notification_read_time = db.Column(db.DateTime())
     private_profile = db.Column(db.Boolean, default=False)
+    # changed when the profile (avatar, department...) is edited, part of the version stamps of cached fragments.
+    # version is incremented with every edit, timestamps alone miss edits within the same second
+    last_update = db.Column(db.DateTime(), default=func.now())
+    version = db.Column(db.Integer(), default=0, nullable=False, server_default="0")
+    # number of assigned tickets computed by the database, deferred - loaded only by listings that ask for it
+    ticket_count = column_property(select(func.count(user_ticket.c.ticket_id))
+                                   .where(user_ticket.c.user_id == id).scalar_subquery(), deferred=True)
+
+    # cached unread counters - incremented when a message/notification is sent, reset when the user reads them.
+    # NULL for accounts created before the counters existed, these are recounted on first read
+    unread_messages = db.Column(db.Integer(), default=0)
+    unread_notifications = db.Column(db.Integer(), default=0)
 
     def new_messages(self):
         # returns number of unread messages, called from HTML
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return UserMessage.query.filter_by(recipient=self).filter(UserMessage.timestamp > last_read_time).count()
+        if self.unread_messages is None:
+            last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
+            self.unread_messages = UserMessage.query.filter_by(recipient=self)\
+                .filter(UserMessage.timestamp > last_read_time).count()
+            db.session.commit()
+        return self.unread_messages
 
     def new_notifications(self):
         # returns number of unread notifications, called from HTML
-        last_read_time = self.last_notification_read_time or datetime(1900, 1, 1)
-        return UserNotification.query.filter_by(recipient=self).filter(UserNotification.timestamp > last_read_time,
-                                                                       UserNotification.author != self).count()
+        if self.unread_notifications is None:
+            last_read_time = self.last_notification_read_time or datetime(1900, 1, 1)
+            self.unread_notifications = UserNotification.query.filter_by(recipient=self)\
+                .filter(UserNotification.timestamp > last_read_time, UserNotification.author != self).count()
+            db.session.commit()
+        return self.unread_notifications
+
+    def read_messages(self):
+        # marks all messages as read, commit is left to the caller
+        self.last_message_read_time = func.now()
+        self.unread_messages = 0
+
+    def read_notifications(self):
+        # marks all notifications as read, commit is left to the caller
+        self.last_notification_read_time = func.now()
+        self.unread_notifications = 0
 
 
 class Project(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
     date_created = db.Column(db.DateTime(), default=func.now())
-    author = db.Column(db.Integer(), db.ForeignKey("user.id"))
+    author = db.Column(db.Integer(), db.ForeignKey("user.id"), index=True)
     name = db.Column(db.Text())
     description = db.Column(db.String())
     status = db.Column(db.String())
     priority = db.Column(db.String())
     deadline = db.Column(db.Date())
-    developers = db.relationship("User", secondary=user_project, backref="projects")
+    developers = db.relationship("User", secondary=user_project, backref="projects", passive_deletes=True)
     file = db.Column(db.String())
-    days_left = db.Column(db.Integer())
-    tickets = db.relationship("Ticket", backref="project", cascade="all,delete")
+    # children are deleted by ON DELETE CASCADE in the database, passive_deletes keeps the ORM from loading them
+    tickets = db.relationship("Ticket", backref="project", cascade="all,delete", passive_deletes=True)
     last_update = db.Column(db.DateTime(), default=func.now())
-    comments = db.relationship("Comment", backref="project", cascade="all,delete")
+    # incremented with every edit, part of the version stamps next to last_update
+    version = db.Column(db.Integer(), default=0, nullable=False, server_default="0")
+    comments = db.relationship("Comment", backref="project", cascade="all,delete", order_by="Comment.id",
+                               passive_deletes=True)
+    # columns recorded in ChangeHistory when the project is edited, developers are always recorded
+    tracked_fields = ("description", "status", "priority", "deadline")
+
+    @hybrid_property
+    def days_left(self):
+        # whole days left until the deadline, computed on read - usable in ORDER BY/WHERE as well
+        return (self.deadline - date.today()).days
+
+    @days_left.expression
+    def days_left(cls):
+        return days_until(cls.deadline)
 
 
 class Ticket(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
     date_created = db.Column(db.DateTime(), default=func.now())
-    author = db.Column(db.Integer(), db.ForeignKey("user.id"))
+    author = db.Column(db.Integer(), db.ForeignKey("user.id"), index=True)
     name = db.Column(db.Text())
     description = db.Column(db.String())
     status = db.Column(db.String())
     type = db.Column(db.String())
-    developers = db.relationship("User", secondary=user_ticket, backref="tickets")
+    developers = db.relationship("User", secondary=user_ticket, backref="tickets", passive_deletes=True)
     file = db.Column(db.String())
     last_update = db.Column(db.DateTime(), default=func.now())
-    project_id = db.Column(db.Integer(), db.ForeignKey("project.id"))
-    comments = db.relationship("Comment", backref="ticket", cascade="all,delete")
+    # incremented with every edit, part of the version stamps next to last_update
+    version = db.Column(db.Integer(), default=0, nullable=False, server_default="0")
+    project_id = db.Column(db.Integer(), db.ForeignKey("project.id", ondelete="CASCADE"), index=True)
+    comments = db.relationship("Comment", backref="ticket", cascade="all,delete", order_by="Comment.id",
+                               passive_deletes=True)
+    tracked_fields = ("description", "status", "type")
 
 
 class Comment(db.Model):
@@ -91,21 +174,28 @@ class Comment(db.Model):
     text = db.Column(db.String())
     date_created = db.Column(db.DateTime(), default=func.now())
     author_id = db.Column(db.Integer(), db.ForeignKey("user.id"))
-    project_id = db.Column(db.Integer(), db.ForeignKey("project.id"), default=None)
-    ticket_id = db.Column(db.Integer(), db.ForeignKey("ticket.id"), default=None)
+    project_id = db.Column(db.Integer(), db.ForeignKey("project.id", ondelete="CASCADE"), default=None, index=True)
+    ticket_id = db.Column(db.Integer(), db.ForeignKey("ticket.id", ondelete="CASCADE"), default=None, index=True)
     file = db.Column(db.String())
     deleted = db.Column(db.Boolean(), default=False)
-    likes = db.relationship("Like", backref="comment", cascade="all,delete")
+    likes = db.relationship("Like", backref="comment", cascade="all,delete", passive_deletes=True)
+    # number of likes, kept in sync by views.like_comment so that threads do not load every Like row
+    like_count = db.Column(db.Integer(), default=0, nullable=False, server_default="0")
 
 
 class Like(db.Model):
+    # a user likes a comment at most once, also serves the "did the user like these comments" lookup
+    __table_args__ = (db.UniqueConstraint("comment_id", "author", name="uq_like_comment_id_author"),)
     id = db.Column(db.Integer(), primary_key=True)
     author = db.Column(db.Integer(), db.ForeignKey("user.id"))
-    comment_id = db.Column(db.Integer(), db.ForeignKey("comment.id"))
+    comment_id = db.Column(db.Integer(), db.ForeignKey("comment.id", ondelete="CASCADE"))
     date_created = db.Column(db.DateTime(), default=func.now())
 
 
 class UserMessage(db.Model):
+    # inbox/sent listings and unread counts filter by the user and order by timestamp
+    __table_args__ = (db.Index("ix_user_message_recipient_id_timestamp", "recipient_id", "timestamp"),
+                      db.Index("ix_user_message_sender_id_timestamp", "sender_id", "timestamp"))
     id = db.Column(db.Integer(), primary_key=True)
     sender_id = db.Column(db.Integer(), db.ForeignKey("user.id"))
     recipient_id = db.Column(db.Integer(), db.ForeignKey('user.id'))
@@ -114,6 +204,9 @@ class UserMessage(db.Model):
 
 
 class UserNotification(db.Model):
+    # notifications received (own profile) and sent (activity) filter by the user and order by timestamp
+    __table_args__ = (db.Index("ix_user_notification_recipient_id_timestamp", "recipient_id", "timestamp"),
+                      db.Index("ix_user_notification_sender_id_timestamp", "sender_id", "timestamp"))
     id = db.Column(db.Integer(), primary_key=True)
     sender_id = db.Column(db.Integer(), db.ForeignKey("user.id"))
     recipient_id = db.Column(db.Integer(), db.ForeignKey('user.id'))
@@ -121,3 +214,72 @@ class UserNotification(db.Model):
     body = db.Column(db.String())
     type = db.Column(db.String())
     timestamp = db.Column(db.DateTime(), index=True, default=func.now())
+    # events of the same sender about the same entity ("project:1") within NOTIFICATION_COALESCE_WINDOW are merged
+    # into one unread notification, changes holds the merged change list as JSON [[field, old, new], ...]
+    group_key = db.Column(db.String())
+    changes = db.Column(db.String())
+    event_count = db.Column(db.Integer(), default=1, nullable=False, server_default="1")
+
+
+class UserNotificationArchive(db.Model):
+    # notifications older than NOTIFICATION_RETENTION_DAYS, moved here in batches to keep user_notification small
+    __table_args__ = (db.Index("ix_user_notification_archive_recipient_id_timestamp", "recipient_id", "timestamp"),)
+    id = db.Column(db.Integer(), primary_key=True)  # id of the original UserNotification
+    sender_id = db.Column(db.Integer(), db.ForeignKey("user.id"))
+    recipient_id = db.Column(db.Integer(), db.ForeignKey('user.id'))
+    subject = db.Column(db.String())
+    body = db.Column(db.String())
+    type = db.Column(db.String())
+    timestamp = db.Column(db.DateTime())
+    group_key = db.Column(db.String())
+    changes = db.Column(db.String())
+    event_count = db.Column(db.Integer(), default=1, nullable=False, server_default="1")
+    archived = db.Column(db.DateTime(), default=func.now())
+
+
+class ChangeHistory(db.Model):
+    # one row per changed field of an edited Project/Ticket
+    __table_args__ = (db.Index("ix_change_history_entity_entity_id_timestamp", "entity", "entity_id", "timestamp"),)
+    id = db.Column(db.Integer(), primary_key=True)
+    entity = db.Column(db.String())  # "project" or "ticket"
+    entity_id = db.Column(db.Integer())
+    field = db.Column(db.String())
+    old_value = db.Column(db.String())
+    new_value = db.Column(db.String())
+    actor_id = db.Column(db.Integer(), db.ForeignKey("user.id"))
+    timestamp = db.Column(db.DateTime(), default=func.now())
+
+
+class FileBlob(db.Model):
+    # uploaded file content stored once under its sha256 digest, ref_count = number of rows pointing to the file
+    id = db.Column(db.Integer(), primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True)
+    size = db.Column(db.Integer())
+    ref_count = db.Column(db.Integer(), default=0)
+    date_created = db.Column(db.DateTime(), default=func.now())
+
+
+class NotificationOutbox(db.Model):
+    # notification events waiting for delivery by the background queue, rows are deleted once delivered,
+    # undelivered rows survive a restart of the process
+    id = db.Column(db.Integer(), primary_key=True)
+    sender_id = db.Column(db.Integer(), db.ForeignKey("user.id"))
+    recipient_ids = db.Column(db.String())  # comma separated User.id
+    subject = db.Column(db.String())
+    body = db.Column(db.String())
+    type = db.Column(db.String())
+    timestamp = db.Column(db.DateTime(), default=func.now())
+    group_key = db.Column(db.String())
+    changes = db.Column(db.String())
+
+
+class MailOutbox(db.Model):
+    # outgoing mails, sent by the background mail queue and deleted once sent
+    id = db.Column(db.Integer(), primary_key=True)
+    subject = db.Column(db.String())
+    recipients = db.Column(db.String())  # comma separated email addresses
+    html = db.Column(db.String())
+    timestamp = db.Column(db.DateTime(), default=func.now())
+    attempts = db.Column(db.Integer(), default=0)
+    next_attempt = db.Column(db.DateTime())  # NULL = send now, also used as a lease while the mail is being sent
+    last_error = db.Column(db.String())
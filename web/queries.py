@@ -0,0 +1,155 @@
+from sqlalchemy import or_, select, func, case
+from sqlalchemy.orm import joinedload, selectinload
+from .models import User, Project, Ticket, Comment, Like, UserNotification, user_project, user_ticket
+from . import db
+from datetime import datetime
+
+
+def user_projects(user):
+    """
+    Returns query of projects the user created or is assigned to as a developer. Visibility is resolved by the
+    database, so listings no longer need to load every project and check project.developers row by row.
+
+    :param user: User object, usually current_user
+    :return: Query of Project objects ordered by id
+    """
+    assigned = select(user_project.c.project_id).where(user_project.c.user_id == user.id)
+    return Project.query.filter(or_(Project.author == user.id, Project.id.in_(assigned))).order_by(Project.id)
+
+
+def user_tickets(user):
+    """
+    Returns query of tickets the user created or is assigned to as a developer.
+
+    :param user: User object, usually current_user
+    :return: Query of Ticket objects ordered by id
+    """
+    assigned = select(user_ticket.c.ticket_id).where(user_ticket.c.user_id == user.id)
+    return Ticket.query.filter(or_(Ticket.author == user.id, Ticket.id.in_(assigned))).order_by(Ticket.id)
+
+
+def liked_comment_ids(user, comment_ids):
+    """
+    Returns ids of the comments liked by the user, answered with one query for a whole comment thread.
+
+    :param user: User object, usually current_user
+    :param comment_ids: list of Comment.id
+    :return: set of Comment.id
+    """
+    if not comment_ids:
+        return set()
+    liked = Like.query.with_entities(Like.comment_id).filter(Like.author == user.id, Like.comment_id.in_(comment_ids))
+    return {comment_id for comment_id, in liked}
+
+
+def project_thread(project_id):
+    """
+    Loads the project with its developers and tickets in a fixed number of queries. Comments are loaded by
+    thread_comments only when the cached comment thread has to be rendered again.
+
+    :param project_id: Project.id
+    :return: Project object, aborts with 404 if not found
+    """
+    return Project.query.options(selectinload(Project.developers),
+                                 selectinload(Project.tickets))\
+        .filter_by(id=project_id).first_or_404()
+
+
+def ticket_thread(ticket_id):
+    """
+    Loads the ticket with its project and developers in a fixed number of queries.
+
+    :param ticket_id: Ticket.id
+    :return: Ticket object, aborts with 404 if not found
+    """
+    return Ticket.query.options(joinedload(Ticket.project),
+                                selectinload(Ticket.developers))\
+        .filter_by(id=ticket_id).first_or_404()
+
+
+def thread_comments(*criteria):
+    """
+    Loads comments of a thread with their authors in one query, no matter how long the thread is. Like counts are
+    stored on the comments.
+
+    :param criteria: filter of the thread, e.g. Comment.project_id == project.id
+    :return: list of Comment objects ordered by id
+    """
+    return Comment.query.options(joinedload(Comment.user)).filter(*criteria).order_by(Comment.id).all()
+
+
+def thread_version(user, *criteria):
+    """
+    Returns version stamp of a comment thread as seen by the user, used as the key of the cached thread. The stamp
+    changes when a comment is added or deleted, a like is added or removed, or a comment author edits the profile.
+    It is built from ids, counts and version counters, timestamps only give the Last-Modified date.
+
+    :param user: User object, usually current_user
+    :param criteria: filter of the thread, e.g. Comment.project_id == project.id
+    :return: tuple (number of comments, String with the stamp, datetime of the last new comment/like or None)
+    """
+    comments = db.session.query(func.count(Comment.id),
+                                func.max(Comment.id),
+                                func.count(case((Comment.deleted == True, 1))),
+                                func.sum(User.version),
+                                func.max(User.last_update),
+                                func.max(Comment.date_created))\
+        .join(User, Comment.author_id == User.id).filter(*criteria).one()
+    # the likes of the user decide the stars, the others only the counts
+    likes = db.session.query(func.count(Like.id),
+                             func.max(Like.id),
+                             func.count(case((Like.author == user.id, Like.id))),
+                             func.max(case((Like.author == user.id, Like.id))),
+                             func.max(Like.date_created))\
+        .join(Comment, Like.comment_id == Comment.id).filter(*criteria).one()
+    return comments[0], "-".join(str(value) for value in tuple(comments[:4]) + tuple(likes[:4])), \
+        latest(comments[4], comments[5], likes[4])
+
+
+def page_version(entity, developers_column, *tickets_criteria):
+    """
+    Returns version stamp of the project/ticket page apart from the comments: the row itself, its developers
+    (names, departments) and for projects the list of tickets. Edits increment version and set last_update of
+    the row.
+
+    :param entity: Project or Ticket object
+    :param developers_column: user_project.c.project_id or user_ticket.c.ticket_id
+    :param tickets_criteria: filter of the listed tickets, e.g. Ticket.project_id == project.id
+    :return: tuple (String with the stamp, datetime of the last change or None)
+    """
+    developers_table = developers_column.table
+    developers = db.session.query(func.count(User.id), func.sum(User.version), func.max(User.last_update))\
+        .join(developers_table, developers_table.c.user_id == User.id).filter(developers_column == entity.id).one()
+    tickets = (None, None, None, None)
+    if tickets_criteria:
+        tickets = db.session.query(func.count(Ticket.id), func.max(Ticket.id), func.sum(Ticket.version),
+                                   func.max(Ticket.last_update))\
+            .filter(*tickets_criteria).one()
+    values = (entity.id, entity.version, entity.file) + tuple(developers[:2]) + tuple(tickets[:3])
+    return "-".join(str(value) for value in values), latest(entity.last_update, developers[2], tickets[3])
+
+
+def profile_version(user):
+    """
+    Returns version stamp of the profile page: the profile itself, its assigned tickets and the latest notification
+    the user received.
+
+    :param user: User object of the profile
+    :return: tuple (String with the stamp, datetime of the last change or None)
+    """
+    tickets = db.session.query(func.count(Ticket.id), func.max(Ticket.id), func.sum(Ticket.version),
+                               func.max(Ticket.last_update))\
+        .join(user_ticket, user_ticket.c.ticket_id == Ticket.id).filter(user_ticket.c.user_id == user.id).one()
+    # coalescing updates the latest notification in place and increments its event_count
+    notifications = db.session.query(func.max(UserNotification.id), func.sum(UserNotification.event_count),
+                                     func.max(UserNotification.timestamp))\
+        .filter(UserNotification.recipient_id == user.id).one()
+    values = (user.id, user.version) + tuple(tickets[:3]) + tuple(notifications[:2])
+    return "-".join(str(value) for value in values), latest(user.last_update, tickets[3], notifications[2])
+
+
+def latest(*timestamps):
+    # newest of the timestamps, None if there is none. SQLite returns aggregates of datetime columns as strings
+    values = [datetime.fromisoformat(value) if isinstance(value, str) else value
+              for value in timestamps if value is not None]
+    return max(values) if values else None
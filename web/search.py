@@ -0,0 +1,144 @@
+from sqlalchemy import or_, select, literal, literal_column, union_all, func, table, column
+from sqlalchemy.orm import joinedload
+from .models import Project, Ticket, Comment, UserMessage, user_project, user_ticket
+from . import db
+import re
+
+
+# full-text index over the searched columns, created by migration 0007:
+#  SQLite - FTS5 tables <table>_fts with the rows as external content, kept in sync by triggers
+#  PostgreSQL - generated tsvector column <table>.search_vector with a GIN index
+PAGE_SIZE = 20
+WORD = re.compile(r"\w+")
+# kind -> (model, table name, weights of the indexed columns - name ranks above description)
+SEARCHED = {
+    "project": (Project, "project", (10.0, 1.0)),
+    "ticket": (Ticket, "ticket", (10.0, 1.0)),
+    "comment": (Comment, "comment", (1.0,)),
+    "message": (UserMessage, "user_message", (1.0,)),
+}
+
+
+### BACKENDS ###
+class SQLiteSearch:
+    """
+    Matches with FTS5, ranked by bm25. Every word must match, the last one as a prefix (search as you type).
+    """
+
+    @staticmethod
+    def query(words):
+        return " ".join(f'"{word}"' for word in words) + "*"
+
+    def match(self, kind, words):
+        model, table_name, weights = SEARCHED[kind]
+        index = table(f"{table_name}_fts", column("rowid"))
+        rank = -func.bm25(literal_column(index.name), *weights)
+        return (index.join(model.__table__, model.id == index.c.rowid),
+                literal_column(index.name).op("MATCH")(self.query(words)),
+                rank)
+
+
+class PostgresSearch:
+    """
+    Matches with the tsvector column, ranked by ts_rank. Every word must match, the last one as a prefix.
+    """
+
+    @staticmethod
+    def query(words):
+        return " & ".join(words[:-1] + [f"{words[-1]}:*"])
+
+    def match(self, kind, words):
+        model, table_name, weights = SEARCHED[kind]
+        vector = literal_column(f"{table_name}.search_vector")
+        tsquery = func.to_tsquery("english", self.query(words))
+        return model.__table__, vector.op("@@")(tsquery), func.ts_rank(vector, tsquery)
+
+
+def backend():
+    if db.engine.dialect.name == "sqlite":
+        return SQLiteSearch()
+    return PostgresSearch()
+
+
+### VISIBILITY ###
+def visible(kind, user):
+    """
+    Returns condition limiting the rows of kind to those the user may see: own and assigned projects and tickets,
+    tickets and comments of those projects, comments of those tickets and own messages.
+
+    :param kind: key of SEARCHED
+    :param user: User object, usually current_user
+    :return: SQL expression
+    """
+    projects = select(Project.id).where(or_(Project.author == user.id, Project.id.in_(
+        select(user_project.c.project_id).where(user_project.c.user_id == user.id))))
+    tickets = select(Ticket.id).where(or_(Ticket.author == user.id, Ticket.project_id.in_(projects), Ticket.id.in_(
+        select(user_ticket.c.ticket_id).where(user_ticket.c.user_id == user.id))))
+    if kind == "project":
+        return Project.id.in_(projects)
+    if kind == "ticket":
+        return Ticket.id.in_(tickets)
+    if kind == "comment":
+        return ~Comment.deleted & or_(Comment.project_id.in_(projects), Comment.ticket_id.in_(tickets))
+    return or_(UserMessage.sender_id == user.id, UserMessage.recipient_id == user.id)
+
+
+### SEARCH ###
+def search(user, text, kinds=tuple(SEARCHED), page=1, page_size=PAGE_SIZE):
+    """
+    Full-text search over projects, tickets, comments and messages visible to the user.
+    Best matches come first, one query answers a page of results over all kinds.
+
+    :param user: User object, usually current_user
+    :param text: String typed by the user, words are matched regardless of the search syntax of the database
+    :param kinds: kinds of results, keys of SEARCHED
+    :param page: number of the page starting from 1
+    :param page_size: number of results on a page
+    :return: tuple (list of (kind, object) tuples, True if there is a next page)
+    """
+    words = WORD.findall(text.lower())
+    kinds = [kind for kind in kinds if kind in SEARCHED]
+    if not words or not kinds:
+        return [], False
+    search_backend = backend()
+    selects = []
+    for kind in kinds:
+        model = SEARCHED[kind][0]
+        source, condition, rank = search_backend.match(kind, words)
+        # every kind contributes at most the rows up to the end of the page, the union stays small
+        best = select(literal(kind).label("kind"), model.id.label("id"), rank.label("rank"))\
+            .select_from(source).where(condition, visible(kind, user))\
+            .order_by(rank.desc(), model.id.desc()).limit(page * page_size + 1).subquery()
+        selects.append(select(best))
+    matches = union_all(*selects).subquery()
+    rows = db.session.execute(select(matches.c.kind, matches.c.id)
+                              .order_by(matches.c.rank.desc(), matches.c.kind, matches.c.id.desc())
+                              .offset((page - 1) * page_size).limit(page_size + 1)).all()
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+
+    # load the objects of the page, one query per kind
+    options = {"comment": [joinedload(Comment.user), joinedload(Comment.project), joinedload(Comment.ticket)],
+               "message": [joinedload(UserMessage.author), joinedload(UserMessage.recipient)]}
+    objects = {}
+    for kind in {kind for kind, _ in rows}:
+        model = SEARCHED[kind][0]
+        ids = [object_id for row_kind, object_id in rows if row_kind == kind]
+        for item in model.query.options(*options.get(kind, [])).filter(model.id.in_(ids)):
+            objects[(kind, item.id)] = item
+    return [(kind, objects[(kind, object_id)]) for kind, object_id in rows if (kind, object_id) in objects], has_next
+
+
+def rebuild_index():
+    """
+    Rebuilds the SQLite FTS5 tables from their content tables, e.g. after rows were changed with triggers disabled.
+    PostgreSQL keeps the generated columns up to date by itself.
+
+    :return: True if the index was rebuilt
+    """
+    if db.engine.dialect.name != "sqlite":
+        return False
+    for _, table_name, _ in SEARCHED.values():
+        db.session.execute(db.text(f"INSERT INTO {table_name}_fts({table_name}_fts) VALUES ('rebuild')"))
+    db.session.commit()
+    return True
@@ -0,0 +1,220 @@
+from flask import current_app
+from werkzeug.utils import secure_filename
+from sqlalchemy import update, bindparam
+from sqlalchemy.exc import IntegrityError
+from .models import FileBlob
+from . import db, file_queue
+import glob
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from collections import Counter
+
+
+# uploads are stored once per content, under their sha256 digest, and served from /files/<sha256>/<filename>
+CHUNK_SIZE = 64 * 1024
+BLOB_URL = re.compile(r"^/files/(?P<sha256>[0-9a-f]{64})/")
+LEGACY_UPLOADS = "/static/uploads/"
+# square thumbnails of images, one per size the templates display
+THUMBNAIL_SIZES = (40, 48, 64, 128)
+
+
+def blob_path(sha256):
+    """
+    Returns path of the stored file. Files are sharded into two levels of directories by the first four characters
+    of the digest, so that no directory grows too large: {UPLOAD_FOLDER}/ab/cd/abcd...
+
+    :param sha256: hex digest of the file content
+    :return: String with the filesystem path
+    """
+    return os.path.join(current_app.config["UPLOAD_FOLDER"], sha256[:2], sha256[2:4], sha256)
+
+
+def upload_file(file):
+    """
+    Saves a file uploaded by the user and returns string with the url. Content that is already stored is not
+    written again, only its reference count is increased.
+
+    :param file: (werkzeug.datastructures.FileStorage) A file uploaded by the user
+    :return: String with the url: f'/files/{sha256}/{filename}'
+    """
+    # hash the upload while streaming through it
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+        size += len(chunk)
+    sha256 = digest.hexdigest()
+    browser_path = f"/files/{sha256}/{secure_filename(file.filename) or 'file'}"
+
+    # duplicate content - add a reference
+    if FileBlob.query.filter_by(sha256=sha256).update({FileBlob.ref_count: FileBlob.ref_count + 1},
+                                                      synchronize_session=False):
+        db.session.commit()
+        return browser_path
+
+    # new content - write to a temporary file first so that readers never see a partial file
+    save_path = blob_path(sha256)
+    if not os.path.exists(save_path):
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        temporary_path = f"{save_path}.{uuid.uuid4()}.tmp"
+        file.stream.seek(0)
+        file.save(temporary_path)
+        os.replace(temporary_path, save_path)
+    try:
+        with db.session.begin_nested():
+            db.session.add(FileBlob(sha256=sha256, size=size, ref_count=1))
+    except IntegrityError:
+        # the same content was uploaded concurrently
+        FileBlob.query.filter_by(sha256=sha256).update({FileBlob.ref_count: FileBlob.ref_count + 1},
+                                                       synchronize_session=False)
+    db.session.commit()
+    return browser_path
+
+
+def release_file(browser_path):
+    """
+    Drops one reference to a file returned by upload_file. Files without references are deleted from the disk
+    later by the background queue.
+
+    :param browser_path: String with the url of the file, empty string if there is no file
+    :return: True if a reference was dropped
+    """
+    return release_files([browser_path]) > 0
+
+
+def release_files(browser_paths):
+    """
+    Drops one reference per url to files returned by upload_file, e.g. all files of a deleted project.
+    Reference counts are decreased with one batched UPDATE, files are deleted from the disk by the background queue.
+
+    :param browser_paths: list of Strings with the urls, empty strings are skipped
+    :return: number of dropped references
+    """
+    references = Counter()
+    legacy_paths = []
+    legacy_root = os.path.realpath(os.path.join(current_app.root_path, LEGACY_UPLOADS.strip("/")))
+    blob_root = os.path.realpath(current_app.config["UPLOAD_FOLDER"])
+    for browser_path in browser_paths:
+        if not browser_path:
+            continue
+        match = BLOB_URL.match(browser_path)
+        if match is not None:
+            references[match.group("sha256")] += 1
+        elif browser_path.startswith(LEGACY_UPLOADS):
+            # file uploaded before the blob store existed, stored under web/static/uploads
+            path = os.path.realpath(os.path.join(legacy_root, browser_path[len(LEGACY_UPLOADS):]))
+            # never leave the legacy folder or touch the blob store, whatever the (user chosen) path contains
+            if os.path.commonpath([legacy_root, path]) == legacy_root != path \
+                    and os.path.commonpath([blob_root, path]) != blob_root and not blob_root.startswith(path + os.sep):
+                legacy_paths.append(path)
+    if references:
+        statement = update(FileBlob.__table__)\
+            .where(FileBlob.__table__.c.sha256 == bindparam("digest"))\
+            .values(ref_count=FileBlob.__table__.c.ref_count - bindparam("references"))
+        db.session.execute(statement, [{"digest": sha256, "references": count}
+                                       for sha256, count in references.items()])
+        db.session.commit()
+        file_queue.submit(collect_orphan_files)
+    if legacy_paths:
+        file_queue.submit(remove_files, legacy_paths)
+    return sum(references.values())
+
+
+def remove_files(paths):
+    """
+    Deletes files and directories from the disk, paths that do not exist are skipped.
+
+    :param paths: list of filesystem paths
+    :return: number of removed paths
+    """
+    removed = 0
+    for path in paths:
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+    return removed
+
+
+def thumbnail_url(browser_path, size):
+    """
+    Returns url of the smallest thumbnail at least size pixels wide. Urls of files outside the blob store
+    (the default avatar, legacy uploads) and sizes larger than any thumbnail are returned unchanged.
+
+    :param browser_path: String with the url of the image
+    :param size: displayed width and height in pixels
+    :return: String with the url: f'/thumbnails/{sha256}/{size}.webp'
+    """
+    match = BLOB_URL.match(browser_path or "")
+    if match is None:
+        return browser_path
+    for thumbnail_size in sorted(THUMBNAIL_SIZES):
+        if thumbnail_size >= size:
+            return f"/thumbnails/{match.group('sha256')}/{thumbnail_size}.webp"
+    return browser_path
+
+
+def thumbnail_path(sha256, size):
+    return f"{blob_path(sha256)}-{size}.webp"
+
+
+def create_thumbnails(browser_path, sizes=THUMBNAIL_SIZES):
+    """
+    Writes thumbnails of a stored image next to the original file. The image is decoded once for all sizes,
+    thumbnails that already exist are skipped.
+
+    :param browser_path: String with the url returned by upload_file
+    :param sizes: thumbnail widths in pixels
+    :return: True if the file is a readable image
+    """
+    # optional dependency, loaded only when a thumbnail is generated
+    from PIL import Image, ImageOps
+    match = BLOB_URL.match(browser_path or "")
+    if match is None:
+        return False
+    sha256 = match.group("sha256")
+    missing = [size for size in sizes if not os.path.exists(thumbnail_path(sha256, size))]
+    if not missing:
+        return True
+    try:
+        with Image.open(blob_path(sha256)) as image:
+            # let the decoder skip detail that the largest thumbnail does not need (JPEG only)
+            image.draft("RGB", (max(missing), max(missing)))
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+            for size in missing:
+                thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+                temporary_path = f"{thumbnail_path(sha256, size)}.{uuid.uuid4()}.tmp"
+                thumbnail.save(temporary_path, format="WEBP", quality=85, method=4)
+                os.replace(temporary_path, thumbnail_path(sha256, size))
+    except (OSError, Image.DecompressionBombError):
+        # missing file or not an image
+        return False
+    return True
+
+
+def collect_orphan_files():
+    """
+    Deletes stored files that are no longer referenced. The file is removed before the row delete is committed,
+    a concurrent upload of the same content waits for the commit and then stores the file again.
+
+    :return: number of deleted files
+    """
+    deleted = 0
+    for blob_id, sha256 in db.session.query(FileBlob.id, FileBlob.sha256).filter(FileBlob.ref_count <= 0).all():
+        if FileBlob.query.filter(FileBlob.id == blob_id, FileBlob.ref_count <= 0).delete(synchronize_session=False):
+            for path in [blob_path(sha256)] + glob.glob(f"{glob.escape(blob_path(sha256))}-*.webp"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            deleted += 1
+        db.session.commit()
+    return deleted
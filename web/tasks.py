@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundQueue:
+    """
+    Runs functions in a thread pool inside the application context so that requests can return before the work
+    is done. With BACKGROUND_TASKS_SYNC set, functions run immediately in the calling thread and their exceptions
+    are raised to the caller (used by tests).
+    Functions registered with on_start run once in the pool before the first submitted task, e.g. to pick up
+    work left in an outbox table by a previous process. Functions registered with on_failure are retried by
+    retry_later after every failed task, e.g. to deliver what the failed task left in the outbox.
+    """
+
+    def __init__(self, name, app=None):
+        self.name = name
+        self.app = None
+        self.executor = None
+        self.sync = False
+        self.workers = 2
+        self.retry_backoff = 30
+        self.retry_max_delay = 3600
+        self._start_callbacks = []
+        self._failure_callbacks = []
+        # func -> {"timer", "due", "failures"} of the single pending retry of the function
+        self._retries = {}
+        self._lock = threading.Lock()
+        # metrics
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault("BACKGROUND_TASKS_SYNC", False)
+        app.config.setdefault("BACKGROUND_WORKERS", 2)
+        app.config.setdefault("BACKGROUND_RETRY_BACKOFF", 30)
+        app.config.setdefault("BACKGROUND_RETRY_MAX_DELAY", 3600)
+        self.sync = app.config["BACKGROUND_TASKS_SYNC"]
+        self.workers = app.config["BACKGROUND_WORKERS"]
+        self.retry_backoff = app.config["BACKGROUND_RETRY_BACKOFF"]
+        self.retry_max_delay = app.config["BACKGROUND_RETRY_MAX_DELAY"]
+
+    def on_start(self, func):
+        if func not in self._start_callbacks:
+            self._start_callbacks.append(func)
+        return func
+
+    def on_failure(self, func):
+        if func not in self._failure_callbacks:
+            self._failure_callbacks.append(func)
+        return func
+
+    def _start(self):
+        # thread pool is created lazily, worker processes that never submit a task never start threads
+        with self._lock:
+            if self.executor is not None:
+                return False
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+            self.submitted += len(self._start_callbacks)
+        for func in self._start_callbacks:
+            self.executor.submit(self._run, func, (), {}, time.monotonic())
+        return True
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedules func(*args, **kwargs) to run in the background.
+
+        :return: True if successful
+        """
+        with self._lock:
+            self.submitted += 1
+        if self.sync:
+            self._run(func, args, kwargs, time.monotonic())
+            return True
+        self._start()
+        self.executor.submit(self._run, func, args, kwargs, time.monotonic())
+        return True
+
+    def retry_later(self, func, delay=None):
+        """
+        Schedules one background run of func after delay seconds. Without a delay the run is a retry after a failure,
+        the delay starts at BACKGROUND_RETRY_BACKOFF and doubles with every retry that fails again (up to
+        BACKGROUND_RETRY_MAX_DELAY). Each function has at most one pending retry, further calls can only bring it
+        forward, so any number of failed tasks leads to a single timer. Ignored in the synchronous mode.
+
+        :param func: function without arguments, e.g. a sweep of an outbox table
+        :param delay: seconds to wait, None for the backoff
+        :return: True if scheduled
+        """
+        if self.sync:
+            return False
+        with self._lock:
+            retry = self._retries.setdefault(func, {"timer": None, "due": 0.0, "failures": 0})
+            backoff = delay is None
+            if backoff:
+                delay = min(self.retry_backoff * 2 ** retry["failures"], self.retry_max_delay)
+            due = time.monotonic() + delay
+            if retry["timer"] is not None:
+                if retry["due"] <= due:
+                    return True
+                retry["timer"].cancel()
+            if backoff:
+                retry["failures"] += 1
+            timer = threading.Timer(delay, self._retry, args=(func,))
+            timer.daemon = True
+            retry["timer"], retry["due"] = timer, due
+            timer.start()
+        return True
+
+    def _retry(self, func):
+        with self._lock:
+            retry = self._retries[func]
+            retry["timer"] = None
+            failures = retry["failures"]
+
+        @functools.wraps(func)
+        def run():
+            func()
+            # the retry succeeded without asking for another one, the next failure starts with the initial backoff
+            with self._lock:
+                if retry["failures"] == failures:
+                    retry["failures"] = 0
+
+        self.submit(run)
+
+    def _run(self, func, args, kwargs, submitted_at):
+        lag = time.monotonic() - submitted_at
+        with self._lock:
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+        try:
+            if self.sync:
+                func(*args, **kwargs)
+            else:
+                with self.app.app_context():
+                    func(*args, **kwargs)
+        except Exception:
+            logger.exception("%s: background task %s failed", self.name, func.__name__)
+            with self._lock:
+                self.failed += 1
+            for callback in self._failure_callbacks:
+                self.retry_later(callback)
+            # synchronous mode runs the tests, they have to see the failure
+            if self.sync:
+                raise
+            return
+        with self._lock:
+            self.completed += 1
+
+    def depth(self):
+        # tasks submitted and not finished yet
+        return self.submitted - self.completed - self.failed
+
+    def stats(self):
+        return {"submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "depth": self.depth(),
+                "last_lag_seconds": self.last_lag,
+                "max_lag_seconds": self.max_lag}
@@ -1,14 +1,26 @@
-from flask import Blueprint, render_template, flash, redirect, url_for, request
+from flask import Blueprint, current_app, render_template, flash, redirect, url_for, request, jsonify, Response, abort, send_file, \
+    make_response
 from flask_login import login_required, current_user
-from .models import Project, User, Ticket, Comment, Like, UserMessage, UserNotification
+from .models import Project, User, Ticket, Comment, Like, UserMessage, UserNotification, ChangeHistory, user_project, \
+    user_ticket
 from .forms import NewProjectForm, NewTicketForm, EditProjectForm, CommentForm, EditTicketForm, EditProfileForm, InviteForm, MessageForm
-from . import db, mail
-from .helpers import update_days_left, upload_file, store_version, compare_versions, send_notification
+from . import db, events, file_queue, fragments, metrics, identity
+from .helpers import store_version, record_changes, describe_changes, send_notification, count_unread, queue_mail, \
+    page_etag, not_modified, conditional
+from .storage import upload_file, release_file, release_files, blob_path, BLOB_URL, LEGACY_UPLOADS, THUMBNAIL_SIZES, create_thumbnails, thumbnail_path
+from .queries import user_projects, user_tickets, liked_comment_ids, project_thread, ticket_thread, thread_comments, \
+    thread_version, page_version, profile_version, latest
+from .datatables import datatable_response
+from .search import search as full_text_search, SEARCHED
+from sqlalchemy import or_
 from sqlalchemy.sql import func
+from sqlalchemy.orm import joinedload, undefer
+from sqlalchemy.exc import IntegrityError
 import os
-import shutil
+import hashlib
+import hmac
+import mimetypes
 from datetime import date
-from flask_mail import Message
 from datetime import datetime
 
 
@@ -17,25 +29,183 @@ views = Blueprint("views", __name__)
 
 ### SIDEBAR NOTIFICATIONS ###
 #  Functions answer to HTMX sidebar calls to check if any new messages/notifications were received.
-#  Returns updated html div. HTMX calls these functions every 20 seconds.
-@views.route('/notification-messages')
+#  Returns updated html div. HTMX calls these functions when the event stream announces a change.
+@views.route('/events')
 @login_required
-def message_notification():
-    referrer = request.referrer
-    # the "message" tab will be marked active if url contains "message"
-    if "message" in referrer:
-        return render_template('notification-messages.html', active="messages")
-    return render_template('notification-messages.html')
+def event_stream():
+    """
+    Server-Sent Events stream pushing "messages"/"notifications" events to the sidebar of the current_user.
+    """
+    user_id = current_user.id
+    # the stream lives as long as the tab is open - release the database connection of the request now instead of
+    # keeping it checked out (and the request context alive) for the whole stream
+    db.session.remove()
+    return Response(events.stream(user_id=user_id), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@views.route('/sidebar-status')
+@login_required
+def sidebar_status():
+    """
+    Returns both sidebar badges as out-of-band HTMX swaps. Answers 304 with no body when the badges did not change
+    since the last request of the browser (If-None-Match).
+    """
+    active = request.args.get("active", "")
+    # badges are rendered from the cached counters of current_user, no other query is needed
+    state = f"{current_user.id}-{current_user.new_notifications()}-{current_user.new_messages()}-{active}"
+    etag = hashlib.sha1(state.encode()).hexdigest()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(render_template('sidebar-status.html', active=active))
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+### MONITORING ###
+@views.route('/metrics')
+def metrics_endpoint():
+    """
+    Request, queue and cache metrics of this process (of all workers with METRICS_DIR) in the Prometheus text
+    format. Available to users listed
+    in ADMIN_EMAILS and to scrapers sending "Authorization: Bearer <METRICS_TOKEN>".
+    """
+    token = current_app.config["METRICS_TOKEN"]
+    authorization = request.headers.get("Authorization", "")
+    scraper = bool(token) and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+    admin = current_user.is_authenticated and current_user.email in current_app.config["ADMIN_EMAILS"]
+    if not scraper and not admin:
+        abort(403)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+### DATATABLES DATA SOURCES ###
+#  JSON endpoints speaking the DataTables server-side processing protocol. Tables load one page at a time
+#  instead of rendering every row into the HTML page.
+@views.route('/data/projects')
+@login_required
+def data_projects():
+    return datatable_response(query=user_projects(current_user),
+                              model=Project,
+                              columns=[(Project.name, "project_name"),
+                                       (Project.days_left, "project_days_left"),
+                                       (Project.status, "status_badge"),
+                                       (Project.priority, "project_priority")],
+                              args=request.args,
+                              search_columns=[Project.name, Project.status, Project.priority])
+
+
+@views.route('/data/tickets')
+@login_required
+def data_tickets():
+    return datatable_response(query=user_tickets(current_user),
+                              model=Ticket,
+                              columns=[(Ticket.name, "ticket_name"),
+                                       (Ticket.type, "ticket_type"),
+                                       (Ticket.status, "status_badge"),
+                                       (Ticket.last_update, "last_update")],
+                              args=request.args,
+                              search_columns=[Ticket.name, Ticket.type, Ticket.status])
+
+
+@views.route('/data/people')
+@login_required
+def data_people():
+    return datatable_response(query=User.query.options(undefer(User.ticket_count)),
+                              model=User,
+                              columns=[(User.username, "user_name"),
+                                       (User.department, "user_department"),
+                                       (User.ticket_count, "user_ticket_count"),
+                                       (User.email, "user_email")],
+                              args=request.args,
+                              search_columns=[User.username, User.department, User.email])
+
+
+@views.route('/data/messages-received')
+@login_required
+def data_messages_received():
+    return datatable_response(query=current_user.messages_received.options(joinedload(UserMessage.author)),
+                              model=UserMessage,
+                              columns=[(None, "message_author"),
+                                       (UserMessage.timestamp, "timestamp"),
+                                       (None, "message_body")],
+                              args=request.args,
+                              search_columns=[UserMessage.body])
+
+
+@views.route('/data/messages-sent')
+@login_required
+def data_messages_sent():
+    return datatable_response(query=current_user.messages_sent.options(joinedload(UserMessage.recipient)),
+                              model=UserMessage,
+                              columns=[(None, "message_recipient"),
+                                       (UserMessage.timestamp, "timestamp"),
+                                       (None, "message_body")],
+                              args=request.args,
+                              search_columns=[UserMessage.body])
 
 
-@views.route('/notification-profile')
+@views.route('/data/notifications')
 @login_required
-def profile_notification():
-    referrer = request.referrer
-    # the "home" tab will be marked active if url contains either "home", "profile" or is "/"
-    if "home" in referrer or "profile" in referrer or referrer[-1] == "/":
-        return render_template('notification-profile.html', active="home")
-    return render_template('notification-profile.html')
+def data_notifications():
+    return datatable_response(query=current_user.notification_received.options(joinedload(UserNotification.author)),
+                              model=UserNotification,
+                              columns=[(None, "notification_author"),
+                                       (UserNotification.timestamp, "timestamp"),
+                                       (None, "notification_body")],
+                              args=request.args,
+                              search_columns=[UserNotification.subject, UserNotification.body])
+
+
+@views.route('/data/activity/<int:id_number>')
+@login_required
+def data_activity(id_number):
+    user = User.query.filter_by(id=id_number).first_or_404()
+    # activity of private profiles is visible only to the user
+    if user.private_profile and user.id != current_user.id:
+        return jsonify(error="This profile is private."), 403
+    return datatable_response(query=user.notification_sent,
+                              model=UserNotification,
+                              columns=[(UserNotification.timestamp, "notification_type"),
+                                       (None, "notification_body")],
+                              args=request.args,
+                              search_columns=[UserNotification.subject, UserNotification.body])
+
+
+### FILES ###
+@views.route('/files/<sha256>/<filename>')
+def uploaded_file(sha256, filename):
+    """
+    Serves an uploaded file. The url contains the digest of the content, so it never changes and browsers
+    may cache it forever.
+    """
+    if not BLOB_URL.match(request.path):
+        abort(404)
+    try:
+        response = send_file(blob_path(sha256), mimetype=mimetypes.guess_type(filename)[0],
+                             download_name=filename, max_age=31536000, etag=sha256, conditional=True)
+    except FileNotFoundError:
+        abort(404)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@views.route('/thumbnails/<sha256>/<int:size>.webp')
+def thumbnail(sha256, size):
+    """
+    Serves a square thumbnail of an uploaded image. Thumbnails are normally created in the background after
+    the upload, missing ones are created on the first request.
+    """
+    if size not in THUMBNAIL_SIZES or not BLOB_URL.match(f"/files/{sha256}/"):
+        abort(404)
+    if not os.path.exists(thumbnail_path(sha256, size)) and not create_thumbnails(f"/files/{sha256}/", sizes=[size]):
+        abort(404)
+    response = send_file(thumbnail_path(sha256, size), mimetype="image/webp", max_age=31536000,
+                         etag=f"{sha256}-{size}", conditional=True)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
 
 
 ### MESSAGE FUNCTIONS ###
@@ -48,9 +218,11 @@ def send_message(recipient):
     user = User.query.filter_by(id=recipient).first_or_404()
     form = MessageForm()
     if form.validate_on_submit():
-        message = UserMessage(author=current_user, recipient=user, body=form.text.data)
+        message = UserMessage(sender_id=current_user.id, recipient=user, body=form.text.data)
         db.session.add(message)
         db.session.commit()
+        count_unread(recipient_ids=[user.id], counter=User.unread_messages)
+        events.publish(user_ids=[user.id], event="messages")
         flash('Your message has been sent.', category="success")
         return redirect(url_for('views.profile', id_number=user.id))
     return render_template('message-form.html', form=form, recipient=user, active="messages")
@@ -63,11 +235,9 @@ def messages():
     Render page with DataTables showing received and sent messages. Updates last_message_read_time that is used
     for message notifications.
     """
-    current_user.last_message_read_time = func.now()
+    current_user.read_messages()
     db.session.commit()
-    received_messages = current_user.messages_received.order_by(UserMessage.timestamp.desc())
-    sent_messages = current_user.messages_sent.order_by(UserMessage.timestamp.desc())
-    return render_template('messages.html', messages_received=received_messages.all(), messages_sent=sent_messages.all(), active="messages")
+    return render_template('messages.html', active="messages")
 
 
 ### MENU LINKS ###
@@ -82,13 +252,24 @@ def home():
 @login_required
 def projects():
     """
-    Renders a page with DataTable of all projects/tickets assigned or created by the current_user and
-    calls update_days_left.
+    Renders a page with DataTable of all projects/tickets assigned or created by the current_user.
     """
-    update_days_left()
-    all_projects = Project.query.all()
-    all_ticket = Ticket.query.all()
-    return render_template("projects.html", active="projects", projects=all_projects, tickets=all_ticket)
+    return render_template("projects.html", active="projects")
+
+
+@views.route("/search")
+@login_required
+def search():
+    """
+    Renders a page with full-text search results over projects, tickets, comments and messages visible to
+    the current_user.
+    """
+    query = request.args.get("q", "").strip()
+    kind = request.args.get("kind", "")
+    page = max(request.args.get("page", 1, type=int), 1)
+    results, has_next = full_text_search(user=current_user, text=query, kinds=[kind] if kind else SEARCHED, page=page)
+    return render_template("search.html", active="search", query=query, kind=kind, page=page, results=results,
+                           has_next=has_next)
 
 
 @views.route("/people", methods=["GET", "POST"])
@@ -98,19 +279,17 @@ def people():
     Renders a page with  DataTable of all registered users and a modal window with InviteForm to invite user by mail.
     """
     form = InviteForm()
-    all_users = User.query.all()
     if form.validate_on_submit():
         recipient = form.email.data
         flash('Mail has been sent.', category="success")
         mail_content = render_template('invite-email.html', user=current_user)
-        msg = Message(subject="BugHunter - invitation", html=mail_content, recipients=[recipient])
-        mail.send(msg)
+        queue_mail(subject="BugHunter - invitation", html=mail_content, recipients=[recipient])
     if form.errors:
         # modal automatically closes after submission, even if an error was raised by the form. the error is not
         # visible; code below shows WTForm error from the modal as a flash message on the People page
         for field, errors in form.errors.items():
             flash(', '.join(errors), category="error")
-    return render_template("people.html", active="people", users=all_users, form=form)
+    return render_template("people.html", active="people", form=form)
 
 
 ### PROFILE ###
@@ -130,22 +309,30 @@ def profile(id_number):
         flash('Profile was updated.', category="success")
         if form.file.data:
             # if user uploaded new picture
-            filename = upload_file(file=form.file.data, project_name="avatars")
+            filename = upload_file(file=form.file.data)
+            file_queue.submit(create_thumbnails, filename)
+            release_file(user.avatar)
         user.description = form.description.data
         user.department = form.department.data
         user.avatar = filename
         user.private_profile = form.private.data
+        user.last_update = func.now()
+        user.version = User.version + 1
         db.session.commit()
         return redirect(url_for("views.profile", id_number=user.id, form=form, active="home"))
-    # if user == current_user, update notification_read_time, load profile notifications (=notifications received)
-    if user.id == current_user.id:
-        current_user.last_notification_read_time = func.now()
+    # if user == current_user, update notification_read_time
+    if user.id == current_user.id and current_user.new_notifications():
+        current_user.read_notifications()
         db.session.commit()
-        notification_received = user.notification_received.order_by(UserNotification.timestamp.desc())
-        return render_template("profile.html", user=user, form=form, notifications_received=notification_received, active="home")
-    # if user != current_user,load recent activity (=notifications sent)
-    notification_sent = user.notification_sent.order_by(UserNotification.timestamp.desc())
-    return render_template("profile.html", user=user, form=form, notifications_sent=notification_sent, active="home")
+    # answer revalidation before the assigned tickets are loaded
+    stamp, last_modified = profile_version(user)
+    etag = page_etag("profile", stamp)
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+    # notifications received (own profile) or recent activity (=notifications sent) load from DataTables data sources
+    response = make_response(render_template("profile.html", user=user, form=form, active="home"))
+    return conditional(response, etag, last_modified)
 
 
 # edit profile details
@@ -178,7 +365,7 @@ def new_project():
     if form.validate_on_submit():
         # if user uploaded a project file
         if form.file.data:
-            filename = upload_file(file=form.file.data, project_name=form.name.data)
+            filename = upload_file(file=form.file.data)
         # create database entry
         flash('Project created.', category="success")
         project = Project(
@@ -194,7 +381,7 @@ def new_project():
         db.session.add(project)
         db.session.commit()
         # create UserNotification object
-        send_notification(recipients=project.developers,
+        send_notification(recipient_ids=[developer.id for developer in project.developers],
                           body=f"\n{project.description}",
                           notification_type="create",
                           subject=f"{current_user.username} created project {project.name}")
@@ -206,14 +393,24 @@ def new_project():
 @login_required
 def view_project(id_number):
     """
-    Renders page with project details that allows editing and commenting. Calls update_days_left.
+    Renders page with project details that allows editing and commenting.
     """
-    update_days_left()
     filename = ""
+    # answer revalidation from the version stamps, before the page and its relationships are loaded
+    project = db.get_or_404(Project, id_number)
+    comment_count, thread_stamp, thread_modified = thread_version(current_user, Comment.project_id == project.id)
+    stamp, last_modified = page_version(project, user_project.c.project_id, Ticket.project_id == project.id)
+    etag = page_etag("project", stamp, thread_stamp)
+    last_modified = latest(last_modified, thread_modified)
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
     form = EditProjectForm()
     comment_form = CommentForm()
-    project = Project.query.filter_by(id=id_number).first_or_404()
-    author = User.query.filter_by(id=project.author).first_or_404()
+    project = project_thread(id_number)
+    author = identity.get(project.author)
+    if author is None:
+        abort(404)
 
     # update project details
     if form.validate_on_submit():
@@ -226,20 +423,22 @@ def view_project(id_number):
         project.status = form.status.data
         project.priority = form.priority.data
         project.last_update = func.now()
+        project.version = Project.version + 1
         project.developers = form.developers.data
         project.deadline = form.deadline.data
+        # store changed fields in the change history
+        changes = [[change.field, change.old_value, change.new_value]
+                   for change in record_changes(version=project, old_version=old_version)]
         db.session.commit()
-        # save details after update
-        new_version = store_version(project)
         new_developers = project.developers
-        # compare versions
-        difference = compare_versions(old_version=old_version, new_version=new_version)
         # send notifications to all developers (even if they were removed from the project in last commit)
-        all_developers = set(old_developers + new_developers)
-        send_notification(recipients=all_developers,
-                          body=difference,
+        all_developers = old_developers + new_developers
+        send_notification(recipient_ids=[developer.id for developer in all_developers],
+                          body=describe_changes(changes),
                           notification_type="update",
-                          subject=f"{current_user.username} updated project {project.name}")
+                          subject=f"{current_user.username} updated project {project.name}",
+                          group_key=f"project:{project.id}",
+                          changes=changes)
         return redirect(url_for("views.view_project", id_number=project.id, active="projects"))
 
     # post comment
@@ -247,7 +446,7 @@ def view_project(id_number):
         flash('Comment posted.', category="success")
         # if file attached
         if comment_form.file.data:
-            filename = upload_file(file=comment_form.file.data, project_name=project.name)
+            filename = upload_file(file=comment_form.file.data)
         # new Comment object
         comment = Comment(
             author_id=current_user.id,
@@ -257,12 +456,19 @@ def view_project(id_number):
         db.session.add(comment)
         db.session.commit()
         # create UserNotification object
-        send_notification(recipients=project.developers,
+        send_notification(recipient_ids=[developer.id for developer in project.developers],
                           body=f"\n{comment_form.text.data}",
                           notification_type="comment",
-                          subject=f"{current_user.username} commented project {project.name}")
+                          subject=f"{current_user.username} commented project {project.name}",
+                          group_key=f"project:{project.id}")
         return redirect(url_for("views.view_project", id_number=project.id, active="projects"))
-    return render_template("project-view.html", active="projects", project=project, comment_form=comment_form, author=author.username)
+    comment_thread = fragments.render("project-comments", stamp=f"{project.id}-{thread_stamp}", user_id=current_user.id,
+                                      render=lambda: render_comment_thread("project-comments.html",
+                                                                           Comment.project_id == project.id))
+    response = make_response(render_template("project-view.html", active="projects", project=project,
+                                             comment_form=comment_form, author=author.username,
+                                             comment_count=comment_count, comment_thread=comment_thread))
+    return conditional(response, etag, last_modified)
 
 
 @views.route("/project-edit/<int:id_number>", methods=["GET", "POST"])
@@ -290,7 +496,7 @@ def delete_project_file(id_number):
     if current_user.id != project.author:
         flash("Only the author can delete this file.", category="error")
     else:
-        os.remove(project.file)
+        release_file(project.file)
         project.file = ""
         db.session.commit()
     return redirect(url_for("views.view_project", id_number=project.id, active="projects"))
@@ -300,25 +506,35 @@ def delete_project_file(id_number):
 @login_required
 def delete_project(id_number):
     """
-    Delete project - db.object set to 'cascade="all,delete"' to delete all associated tickets, comments and files.
+    Delete project - tickets, comments, likes and developer links are deleted by ON DELETE CASCADE in the database,
+    files are released and removed from the disk by the background file queue.
     """
     project = Project.query.filter_by(id=id_number).first_or_404()
     if current_user.id != project.author:
         flash("Only the author can delete this project.", category="error")
-    # delete files
     else:
-        try:
-            shutil.rmtree(f"web/static/uploads/{project.name}")
-        except FileNotFoundError:
-            pass
+        # collect files of the project, its tickets and all comments before the rows are gone
+        ticket_ids = db.session.query(Ticket.id).filter(Ticket.project_id == project.id)
+        filenames = [project.file]
+        filenames += [filename for filename, in db.session.query(Ticket.file)
+                      .filter(Ticket.project_id == project.id, Ticket.file != "")]
+        filenames += [filename for filename, in db.session.query(Comment.file)
+                      .filter(or_(Comment.project_id == project.id, Comment.ticket_id.in_(ticket_ids)),
+                              Comment.file != "")]
         # send notification
-        send_notification(recipients=project.developers,
+        send_notification(recipient_ids=[developer.id for developer in project.developers],
                           body=f"\nall associated tickets and comments were deleted",
                           notification_type="delete",
                           subject=f"{current_user.username} deleted project {project.name}")
-        # delete object
+        # delete object - history rows are not linked by a foreign key
+        ChangeHistory.query.filter(or_((ChangeHistory.entity == "project") & (ChangeHistory.entity_id == project.id),
+                                       (ChangeHistory.entity == "ticket") & ChangeHistory.entity_id.in_(ticket_ids)))\
+            .delete(synchronize_session=False)
+        # folder used by uploads stored before the blob store
+        filenames.append(f"{LEGACY_UPLOADS}{project.name}")
         db.session.delete(project)
         db.session.commit()
+        release_files(filenames)
         flash("Project deleted.", category="success")
     return redirect(url_for("views.projects"))
 
@@ -331,34 +547,49 @@ def view_ticket(id_number):
     Renders page with ticket details that allows editing and commenting.
     """
     filename = ""
+    # answer revalidation from the version stamps, before the page and its relationships are loaded
+    ticket = db.get_or_404(Ticket, id_number)
+    comment_count, thread_stamp, thread_modified = thread_version(current_user, Comment.ticket_id == ticket.id)
+    stamp, last_modified = page_version(ticket, user_ticket.c.ticket_id)
+    etag = page_etag("ticket", stamp, thread_stamp)
+    last_modified = latest(last_modified, thread_modified)
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
     form = EditTicketForm()
     comment_form = CommentForm()
-    ticket = Ticket.query.filter_by(id=id_number).first_or_404()
-    project = Project.query.filter_by(id=ticket.project_id).first_or_404()
-    author = User.query.filter_by(id=ticket.author).first_or_404()
-    # save details before update
-    old_version = store_version(ticket)
-    old_developers = ticket.developers
+    ticket = ticket_thread(id_number)
+    project = ticket.project
+    if project is None:
+        abort(404)
+    author = identity.get(ticket.author)
+    if author is None:
+        abort(404)
     # update ticket details
     if form.validate_on_submit():
         flash('Ticket was updated.', category="success")
+        # save details before update
+        old_version = store_version(ticket)
+        old_developers = ticket.developers
         ticket.description = form.description.data
         ticket.status = form.status.data
         ticket.type = form.type.data
         ticket.last_update = func.now()
+        ticket.version = Ticket.version + 1
         ticket.developers = form.developers.data
+        # store changed fields in the change history
+        changes = [[change.field, change.old_value, change.new_value]
+                   for change in record_changes(version=ticket, old_version=old_version)]
         db.session.commit()
-        # save details after update
-        new_version = store_version(ticket)
         new_developers = ticket.developers
-        # compare versions
-        difference = compare_versions(old_version=old_version, new_version=new_version)
         # send notifications to all developers (even if they were removed from the project in last commit)
-        all_developers = set(old_developers + new_developers)
-        send_notification(recipients=all_developers,
-                          body=difference,
+        all_developers = old_developers + new_developers
+        send_notification(recipient_ids=[developer.id for developer in all_developers],
+                          body=describe_changes(changes),
                           notification_type="update",
-                          subject=f"{current_user.username} updated ticket {ticket.name}")
+                          subject=f"{current_user.username} updated ticket {ticket.name}",
+                          group_key=f"ticket:{ticket.id}",
+                          changes=changes)
         return redirect(url_for("views.view_ticket", id_number=ticket.id, active="projects"))
 
     # post comment
@@ -366,7 +597,7 @@ def view_ticket(id_number):
         flash('Comment posted.', category="success")
         # if file attached
         if comment_form.file.data:
-            filename = upload_file(file=comment_form.file.data, project_name=project.name)
+            filename = upload_file(file=comment_form.file.data)
         # new Comment object
         comment = Comment(
             author_id=current_user.id,
@@ -376,12 +607,19 @@ def view_ticket(id_number):
         db.session.add(comment)
         db.session.commit()
         # creates new UserNotification object
-        send_notification(recipients=ticket.developers,
+        send_notification(recipient_ids=[developer.id for developer in ticket.developers],
                           body=f"\n{comment_form.text.data}",
                           notification_type="comment",
-                          subject=f"{current_user.username} commented ticket {ticket.name}")
+                          subject=f"{current_user.username} commented ticket {ticket.name}",
+                          group_key=f"ticket:{ticket.id}")
         return redirect(url_for("views.view_ticket", id_number=ticket.id, active="projects"))
-    return render_template("ticket-view.html", active="projects", project=project, ticket=ticket, comment_form=comment_form, author=author.username)
+    comment_thread = fragments.render("ticket-comments", stamp=f"{ticket.id}-{thread_stamp}", user_id=current_user.id,
+                                      render=lambda: render_comment_thread("ticket-comments.html",
+                                                                           Comment.ticket_id == ticket.id))
+    response = make_response(render_template("ticket-view.html", active="projects", project=project, ticket=ticket,
+                                             comment_form=comment_form, author=author.username,
+                                             comment_count=comment_count, comment_thread=comment_thread))
+    return conditional(response, etag, last_modified)
 
 
 @views.route("/ticket-edit/<int:id_number>", methods=["GET", "POST"])
@@ -415,7 +653,7 @@ def new_ticket(project_id):
     # if user uploads file
     if form.validate_on_submit():
         if form.file.data:
-            filename = upload_file(file=form.file.data, project_name=form.project.data.name)
+            filename = upload_file(file=form.file.data)
         # create Ticket object
         flash('Ticket created.', category="success")
         ticket = Ticket(
@@ -430,7 +668,7 @@ def new_ticket(project_id):
         db.session.add(ticket)
         db.session.commit()
         # create UserNotification object
-        send_notification(recipients=ticket.developers,
+        send_notification(recipient_ids=[developer.id for developer in ticket.developers],
                           body=f"\n{ticket.description}",
                           notification_type="create",
                           subject=f"{current_user.username} created ticket {ticket.name}")
@@ -442,22 +680,25 @@ def new_ticket(project_id):
 @login_required
 def delete_ticket(id_number):
     """
-    Delete ticket - db.object set to 'cascade="all,delete" to delete comments, likes.
+    Delete ticket - comments, likes and developer links are deleted by ON DELETE CASCADE in the database.
     """
     ticket = Ticket.query.filter_by(id=id_number).first_or_404()
     if current_user.id != ticket.author:
         flash("Only the author can delete this ticket.", category="error")
     else:
-        # delete file
-        if ticket.file != "":
-            os.remove(ticket.file)
+        # collect files of the ticket and its comments before the rows are gone
+        filenames = [ticket.file]
+        filenames += [filename for filename, in db.session.query(Comment.file)
+                      .filter(Comment.ticket_id == ticket.id, Comment.file != "")]
         # create UserNotification object
-        send_notification(recipients=ticket.developers,
+        send_notification(recipient_ids=[developer.id for developer in ticket.developers],
                           body="ticket and all associated comments were deleted",
                           notification_type="delete",
                           subject=f"{current_user.username} deleted project {ticket.name}")
+        ChangeHistory.query.filter_by(entity="ticket", entity_id=ticket.id).delete(synchronize_session=False)
         db.session.delete(ticket)
         db.session.commit()
+        release_files(filenames)
         flash("Ticket deleted.", category="success")
     return redirect(url_for("views.projects"))
 
@@ -472,13 +713,22 @@ def delete_ticket_file(id_number):
     if current_user.id != ticket.author:
         flash("Only the author can delete this file.", category="error")
     else:
-        os.remove(ticket.file)
+        release_file(ticket.file)
         ticket.file = ""
         db.session.commit()
     return redirect(url_for("views.view_ticket", id_number=ticket.id, active="projects"))
 
 
 ### COMMENT FUNCTIONS ###
+def render_comment_thread(template, *criteria):
+    """
+    Renders comments of a project/ticket for the current_user, called when the cached thread is out of date.
+    """
+    comments = thread_comments(*criteria)
+    return render_template(template, comments=comments,
+                           liked_comments=liked_comment_ids(current_user, [comment.id for comment in comments]))
+
+
 @views.route("/comment-delete/<int:id_number>")
 @login_required
 def delete_comment(id_number):
@@ -493,8 +743,8 @@ def delete_comment(id_number):
     else:
         current_time = date.today()
         # delete uploaded file if any
-        if comment.file != "":
-            os.remove(f"web/{comment.file}")
+        release_file(comment.file)
+        comment.file = ""
         comment.text = f"This comment was deleted on {current_time}"
         # mark object as deleted - this will prevent showing the like button
         comment.deleted = True
@@ -503,14 +753,14 @@ def delete_comment(id_number):
     # redirect user to either ticket or project
     if project:
         # create UserNotification object
-        send_notification(recipients=project.developers,
+        send_notification(recipient_ids=[developer.id for developer in project.developers],
                           body="",
                           notification_type="delete",
                           subject=f"{current_user.username} deleted comment in project  {project.name}")
         return redirect(url_for("views.view_project", id_number=project.id, active="projects"))
     if ticket:
         # create UserNotification object
-        send_notification(recipients=ticket.developers,
+        send_notification(recipient_ids=[developer.id for developer in ticket.developers],
                           body="",
                           notification_type="delete",
                           subject=f"{current_user.username} deleted comment in ticket {ticket.name}")
@@ -521,18 +771,26 @@ def delete_comment(id_number):
 @login_required
 def like_comment(comment_id):
     """
-    Handles the like function. Creates or deletes a Like object and returns an updated HTML div
+    Handles the like function. Creates or deletes a Like object, updates Comment.like_count in the same transaction
+    and returns an updated HTML div
     """
     comment = Comment.query.filter_by(id=comment_id).first_or_404()
-    like = Like.query.filter_by(author=current_user.id, comment_id=comment_id).first()
     # if comment already liked, delete the like
-    if like:
-        db.session.delete(like)
-        db.session.commit()
-    # if comment not liked yet, create a new like object
+    unliked = Like.query.filter_by(author=current_user.id, comment_id=comment.id).delete(synchronize_session=False)
+    if unliked:
+        change = -unliked
+    # if comment not liked yet, create a new like object - unique constraint rejects a concurrent double like
     else:
-        like = Like(author=current_user.id, comment_id=comment_id)
-        db.session.add(like)
-        db.session.commit()
+        try:
+            with db.session.begin_nested():
+                db.session.add(Like(author=current_user.id, comment_id=comment.id))
+            change = 1
+        except IntegrityError:
+            change = 0
+    Comment.query.filter_by(id=comment.id).update({Comment.like_count: Comment.like_count + change},
+                                                  synchronize_session=False)
+    db.session.commit()
     # answer to HTMX request with an updated div
-    return render_template("comment-like.html", comment=comment)
\ No newline at end of file
+    db.session.refresh(comment)
+    return render_template("comment-like.html", comment=comment,
+                           liked_comments=liked_comment_ids(current_user, [comment.id]))